@@ -0,0 +1,296 @@
+"""
+Endpoint Benchmark
+
+Seeds the inventory table at one or more scales and drives the routes
+of service/routes.py through the Flask test client with read only,
+mixed and write heavy workloads. Reports the ops/sec of every workload
+and the p50/p99 latency of every operation in it.
+
+Every route is driven. /api/events never ends, so its operation opens a
+stream, reads the first keep-alive and closes it: it measures what a
+client pays to connect, with SSE_KEEPALIVE set to 0 so nothing waits.
+
+The models use PostgreSQL statements (INSERT ... ON CONFLICT,
+UPDATE ... RETURNING), so the benchmark needs a local PostgreSQL. It
+clears the inventory table before and after every scale, so point it
+at a test database:
+  DATABASE_URI=postgresql://... python -m benchmarks.bench_endpoints --scales 1000,100000
+"""
+import argparse
+import logging
+import random
+import time
+from itertools import islice
+from service import app
+from service.dataset import generate_inventories, batches
+from service.models import db, Inventory, RestockThreshold, create_schema
+from service.utils import status
+from tests.factory import InventoryFactory
+
+NDJSON_HEADERS = {"Accept": "application/x-ndjson"}
+
+
+class Workload:
+    """The known rows and the client an operation works with"""
+
+    def __init__(self, client, rng):
+        self.client = client
+        self.rng = rng
+        rows = db.session.execute(
+            db.select(Inventory.inventory_id, Inventory.product_id, Inventory.condition)
+        ).all()
+        db.session.commit()
+        self.rows = [tuple(row) for row in rows]
+        self.next_product_id = max((row[1] for row in self.rows), default=0) + 1
+        # rows created by the benchmark, the only ones it deletes
+        self.created = []
+        # where the change feed client continues, see changes()
+        self.since = None
+
+    def new_inventory(self):
+        """Returns the JSON of an inventory with an unused product_id"""
+        data = InventoryFactory(product_id=self.next_product_id).serialize()
+        del data["inventory_id"]
+        self.next_product_id += 1
+        return data
+
+    def any_row(self):
+        """Returns (inventory_id, product_id, condition) of a random row"""
+        return self.rng.choice(self.rows)
+
+
+######################################################################
+# OPERATIONS, each returns the response of one request
+######################################################################
+def list_page(work):
+    """GET one keyset page of the list"""
+    after = work.any_row()[0]
+    return work.client.get(f"/api/inventories?limit=100&after={after}")
+
+
+def list_filtered(work):
+    """GET a filtered page of the list"""
+    return work.client.get("/api/inventories?condition=NEW&restock_level=LOW&limit=100")
+
+
+def list_ndjson(work):
+    """GET the list of one product as NDJSON"""
+    product_id = work.any_row()[1]
+    resp = work.client.get(f"/api/inventories?product_id={product_id}", headers=NDJSON_HEADERS)
+    resp.get_data()  # drains the stream
+    return resp
+
+
+def get_inventory(work):
+    """GET one inventory"""
+    return work.client.get(f"/inventories/{work.any_row()[0]}")
+
+
+def summary(work):
+    """GET the summary from the summary table"""
+    return work.client.get("/api/inventories/summary")
+
+
+def summary_filtered(work):
+    """GET a summary computed with GROUP BY"""
+    low = work.any_row()[1]
+    return work.client.get(
+        f"/api/inventories/summary?group_by=condition&product_id_min={low}&product_id_max={low + 1000}")
+
+
+def get_thresholds(work):
+    """GET the thresholds of a product"""
+    return work.client.get(f"/api/thresholds/{work.any_row()[1]}")
+
+
+def export(work):
+    """GET the gzipped CSV export of one product"""
+    resp = work.client.get(f"/api/inventories/export?product_id={work.any_row()[1]}&gzip=true")
+    resp.get_data()  # drains the stream
+    return resp
+
+
+def changes(work):
+    """GET the next page of the change feed, like a syncing client"""
+    since = f"&since={work.since}" if work.since else ""
+    resp = work.client.get(f"/api/inventories/changes?limit=100{since}")
+    work.since = resp.headers.get("X-Next-Cursor", work.since)
+    return resp
+
+
+def events(work):
+    """GET an event stream, read its first keep-alive and disconnect"""
+    resp = work.client.get(f"/api/events?product_id={work.any_row()[1]}", buffered=False)
+    if resp.status_code == status.HTTP_200_OK:
+        next(iter(resp.response))
+    resp.close()
+    return resp
+
+
+def index(work):
+    """GET /"""
+    return work.client.get("/")
+
+
+def health(work):
+    """GET /health"""
+    return work.client.get("/health")
+
+
+def stats(work):
+    """GET /stats"""
+    return work.client.get("/stats")
+
+
+def metrics(work):
+    """GET /metrics"""
+    return work.client.get("/metrics")
+
+
+def create(work):
+    """POST one inventory"""
+    resp = work.client.post("/api/inventories", json=work.new_inventory())
+    if resp.status_code == status.HTTP_201_CREATED:
+        data = resp.get_json()
+        work.created.append((data["inventory_id"], data["product_id"], data["condition"]))
+    return resp
+
+
+def bulk_create(work):
+    """POST 100 inventories to the bulk endpoint"""
+    return work.client.post("/api/inventories/bulk",
+                            json=[work.new_inventory() for _ in range(100)])
+
+
+def update(work):
+    """PUT a new quantity into an inventory"""
+    inventory_id, product_id, condition = work.any_row()
+    return work.client.put(f"/inventories/{inventory_id}", json={
+        "product_id": product_id,
+        "condition": condition,
+        "restock_level": "MODERATE",
+        "quantity": work.rng.randint(0, 5000),
+    })
+
+
+def change_quantity(work):
+    """PUT a delta into the stock of a product"""
+    _, product_id, condition = work.any_row()
+    return work.client.put("/inventories/changeQuantity", json={
+        "product_id": product_id, "condition": condition, "delta": 1,
+    })
+
+
+def set_thresholds(work):
+    """PUT thresholds, which recomputes the restock levels of the product"""
+    return work.client.put(f"/api/thresholds/{work.any_row()[1]}",
+                           json={"low": 1, "moderate": 50, "plenty": 500})
+
+
+def delete_thresholds(work):
+    """DELETE the thresholds of a product, which recomputes its restock levels"""
+    return work.client.delete(f"/api/thresholds/{work.any_row()[1]}")
+
+
+def delete(work):
+    """DELETE an inventory the benchmark created"""
+    if not work.created:
+        create(work)
+    return work.client.delete(f"/api/inventories/{work.created.pop()[0]}")
+
+
+def clear_filtered(work):
+    """DELETE the inventories of a product the benchmark created"""
+    if not work.created:
+        create(work)
+    return work.client.delete(f"/api/inventories/clear?product_id={work.created.pop()[1]}")
+
+
+READS = {
+    list_page: 20, list_filtered: 10, list_ndjson: 5, get_inventory: 40,
+    summary: 10, summary_filtered: 5, get_thresholds: 4, export: 2, changes: 5,
+    events: 1, index: 1, health: 2, stats: 2, metrics: 2,
+}
+WRITES = {
+    create: 20, bulk_create: 2, update: 30, change_quantity: 30,
+    set_thresholds: 3, delete_thresholds: 2, delete: 10, clear_filtered: 5,
+}
+WORKLOADS = {
+    "read": (READS, 1.0),
+    "mixed": ({**READS, **WRITES}, 0.8),
+    "write": ({**READS, **WRITES}, 0.2),
+}
+
+
+def seed(rows, rng):
+    """Loads rows synthetic inventories with COPY"""
+    for batch in batches(islice(generate_inventories(1, rng=rng), rows), 100000):
+        Inventory.copy_rows(batch)
+
+
+def percentile(ordered, fraction):
+    """Returns the nearest-rank percentile of a sorted list"""
+    index = max(0, min(len(ordered) - 1, round(fraction * len(ordered)) - 1))
+    return ordered[index]
+
+
+def run_workload(work, name, operations):
+    """Runs operations weighted requests and prints their latencies"""
+    weights, read_share = WORKLOADS[name]
+    reads = [op for op in weights if op in READS]
+    writes = [op for op in weights if op in WRITES]
+    latencies = {}
+    errors = 0
+    started = time.perf_counter()
+    for _ in range(operations):
+        pool = reads if not writes or work.rng.random() < read_share else writes
+        operation = work.rng.choices(pool, [weights[op] for op in pool])[0]
+        begin = time.perf_counter()
+        resp = operation(work)
+        latencies.setdefault(operation.__name__, []).append(time.perf_counter() - begin)
+        errors += resp.status_code >= 500
+    elapsed = time.perf_counter() - started
+
+    print(f"  {name:<8} {operations / elapsed:10,.0f} ops/sec  {errors} errors")
+    for operation, values in sorted(latencies.items()):
+        values.sort()
+        print(f"    {operation:<18} {len(values):6} "
+              f"p50 {percentile(values, 0.5) * 1000:8.2f} ms  "
+              f"p99 {percentile(values, 0.99) * 1000:8.2f} ms")
+
+
+def main():
+    """Seeds every scale and runs every workload against it"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--scales", default="1000,100000",
+                        help="Comma separated numbers of seeded inventories, e.g. 1000,100000,1000000")
+    parser.add_argument("--operations", type=int, default=2000,
+                        help="Requests per workload")
+    parser.add_argument("--workloads", default=",".join(WORKLOADS))
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+    app.logger.setLevel(logging.CRITICAL)
+    logging.getLogger("service.models").setLevel(logging.CRITICAL)
+    app.config["SSE_KEEPALIVE"] = 0
+
+    with app.app_context():
+        create_schema()
+        for scale in [int(value) for value in args.scales.split(",")]:
+            Inventory.delete_by_attributes({})
+            db.session.query(RestockThreshold).delete()
+            db.session.commit()
+            Inventory.cache.clear()
+            try:
+                started = time.perf_counter()
+                seed(scale, random.Random(args.seed))
+                print(f"{scale:,} inventories (seeded in {time.perf_counter() - started:.1f} s)")
+                for name in args.workloads.split(","):
+                    work = Workload(app.test_client(), random.Random(args.seed))
+                    run_workload(work, name, args.operations)
+            finally:
+                db.session.remove()
+                Inventory.delete_by_attributes({})
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Read Path Benchmark
+
+Compares the ORM read path (hydrated Inventory instances, serialize()
+and flask-restx marshalling) with the Core row path used by the list
+and lookup endpoints, and reports rows/sec for both.
+
+The benchmark seeds the database named by DATABASE_URI and clears the
+inventory table before and after it runs, so point it at a test database:
+  DATABASE_URI=postgresql://... python -m benchmarks.bench_read_path --rows 10000
+"""
+import argparse
+import json
+import logging
+import time
+from flask_restx import marshal
+from service import app
+from service.models import db, Inventory
+from service.routes import inventory_model
+from tests.factory import InventoryFactory
+
+
+def seed(rows, batch_size=1000):
+    """Inserts rows fake inventories"""
+    for start in range(0, rows, batch_size):
+        count = min(batch_size, rows - start)
+        Inventory.create_batch(
+            [InventoryFactory().serialize() for _ in range(count)])
+
+
+def orm_path():
+    """Reads the whole table the way the list endpoint used to"""
+    results = [inventory.serialize() for inventory in Inventory.all()]
+    return json.dumps(marshal(results, inventory_model))
+
+
+def row_path():
+    """Reads the whole table through the Core row path"""
+    return json.dumps(Inventory.find_rows({}))
+
+
+def measure(name, func, rows, repeat):
+    """Runs func repeat times and prints the best rows/sec"""
+    best = None
+    for _ in range(repeat):
+        db.session.expunge_all()
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print(f"{name:<10} {best * 1000:10.1f} ms {rows / best:14,.0f} rows/sec")
+    return rows / best
+
+
+def main():
+    """Seeds the table and compares both read paths"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    app.logger.setLevel(logging.CRITICAL)
+
+    with app.app_context():
+        Inventory.delete_by_attributes({})
+        try:
+            seed(args.rows)
+            orm_rate = measure("orm", orm_path, args.rows, args.repeat)
+            row_rate = measure("core rows", row_path, args.rows, args.repeat)
+            print(f"speedup    {row_rate / orm_rate:10.2f}x")
+        finally:
+            db.session.remove()
+            Inventory.delete_by_attributes({})
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""
+Startup Benchmark
+
+Measures how long a fresh worker process takes to import the service
+and to answer its first and second requests, which is what a gunicorn
+worker pays on every boot. Each run starts a new interpreter and the
+median of the runs is reported.
+
+The service must find its schema in the database named by DATABASE_URI:
+  flask inventory create-schema
+  DATABASE_URI=postgresql://... python -m benchmarks.bench_startup --runs 5
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+# run in every fresh interpreter, prints its timings as JSON
+WORKER_SCRIPT = """
+import json, logging, time
+started = time.perf_counter()
+from service import app
+imported = time.perf_counter()
+app.logger.setLevel(logging.CRITICAL)
+client = app.test_client()
+client.get("/api/inventories?limit=1")
+first = time.perf_counter()
+client.get("/api/inventories?limit=1")
+second = time.perf_counter()
+print(json.dumps({
+    "import": imported - started,
+    "first request": first - imported,
+    "second request": second - first,
+}))
+"""
+
+
+def run_worker():
+    """Starts an interpreter that imports the service and returns its timings"""
+    result = subprocess.run([sys.executable, "-c", WORKER_SCRIPT],
+                            capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+def main():
+    """Starts fresh workers and prints the median of their timings"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    runs = [run_worker() for _ in range(args.runs)]
+    for name in runs[0]:
+        median = statistics.median(run[name] for run in runs)
+        print(f"{name:<15} {median * 1000:10.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -14,22 +14,24 @@ from compare import expect
 @given('the following inventories')
 def step_impl(context):
     """ Delete all Inventories and load new ones """
-    # List all of the Inventories and delete them one by one
+    # Delete all of the Inventories with one request
     rest_endpoint = f"{context.BASE_URL}/api/inventories"
-    context.resp = requests.get(rest_endpoint)
-    expect(context.resp.status_code).to_equal(200)
-    for inventory in context.resp.json():
-        context.resp = requests.delete(f"{rest_endpoint}/{inventory['inventory_id']}")
-        expect(context.resp.status_code).to_equal(204)
+    context.resp = requests.delete(f"{rest_endpoint}/clear")
+    expect(context.resp.status_code).to_equal(204)
 
-    # load the database with new pets
-    for row in context.table:
-        payload = {
+    # load the database with new pets in one bulk request
+    payload = [
+        {
             "condition": row['condition'],
-            "product_id": row['product_id'],
-            "quantity": row['quantity'],
+            "product_id": int(row['product_id']),
+            "quantity": int(row['quantity']),
             "restock_level": row['restock_level'],
         }
-        context.resp = requests.post(rest_endpoint, json=payload)
-        context.clipboard = context.resp.json()['inventory_id']
-        expect(context.resp.status_code).to_equal(201)
+        for row in context.table
+    ]
+    context.resp = requests.post(f"{rest_endpoint}/bulk", json=payload)
+    expect(context.resp.status_code).to_equal(200)
+    results = context.resp.json()['results']
+    for result in results:
+        expect(result['status']).to_equal(201)
+    context.clipboard = results[-1]['inventory_id']
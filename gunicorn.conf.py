@@ -0,0 +1,45 @@
+"""
+Gunicorn settings
+
+Prepares the directory the workers share their Prometheus metrics in,
+see service/utils/metrics.py, and keeps preloaded database connections
+out of the forked workers.
+
+Every client of /api/events holds a request open for as long as it
+stays connected. The workers are threaded, so a stream takes one thread
+and not the whole worker, and a worker with streams open still answers
+its heartbeat. Keep GUNICORN_THREADS above SSE_MAX_CLIENTS, the threads
+left over serve the other requests.
+"""
+import os
+import shutil
+import sys
+
+from prometheus_client import multiprocess
+
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+threads = int(os.getenv("GUNICORN_THREADS", "32"))
+
+
+def on_starting(server):
+    """Removes the metrics files of the previous run"""
+    multiproc_dir = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+    if multiproc_dir:
+        shutil.rmtree(multiproc_dir, ignore_errors=True)
+        os.makedirs(multiproc_dir)
+        server.log.info("Collecting worker metrics in %s", multiproc_dir)
+
+
+def child_exit(server, worker):  # pylint: disable=unused-argument
+    """Drops the live gauges of a worker that exited"""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        multiprocess.mark_process_dead(worker.pid)
+
+
+def post_fork(server, worker):  # pylint: disable=unused-argument
+    """Makes a worker open its own database connections"""
+    if "service" in sys.modules:
+        # the app was preloaded in the master
+        from service import app  # pylint: disable=import-outside-toplevel
+        from service.models import dispose_engines  # pylint: disable=import-outside-toplevel
+        dispose_engines(app)
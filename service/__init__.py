@@ -3,8 +3,11 @@ Package: service
 Package for the application models and service routes
 This module creates and configures the Flask app and sets up the logging
 and SQL database
+
+Nothing here connects to the database, so the app can be imported by a
+gunicorn --preload master before the workers fork. The schema is
+created with: flask inventory create-schema
 """
-import sys
 import logging  # noqa: F401 E402
 from flask import Flask
 from flask_restx import Api
@@ -29,24 +32,36 @@ api = Api(app,
 
 
 # Dependencies require we import the routes AFTER the Flask app is created
+# The metrics hooks go first so they time the whole request
+from .utils import metrics  # pylint: disable=wrong-import-position  # noqa: F401 E402
 from service import (  # noqa: F401 E402
     routes,
     models,
+    commands,
 )  # pylint: disable=wrong-import-position, wrong-import-order
 from .utils import error_handlers  # pylint: disable=wrong-import-position  # noqa: F401 E402
 
-# Set up logging for production
-log_handlers.init_logging(app, "gunicorn.error")
 
-app.logger.info(70 * "*")
-app.logger.info("  S E R V I C E   R U N N I N G  ".center(70, "*"))
-app.logger.info(70 * "*")
+def create_app():
+    """Sets up logging and the database session of the application
+
+    Called once when the package is imported, later calls return the
+    same app. No connection is made before the first request.
+    """
+    if "sqlalchemy" in app.extensions:
+        return app
+
+    # Set up logging for production
+    log_handlers.init_logging(app, "gunicorn.error")
+
+    app.logger.info(70 * "*")
+    app.logger.info("  S E R V I C E   R U N N I N G  ".center(70, "*"))
+    app.logger.info(70 * "*")
+
+    models.Inventory.init_app(app)
+
+    app.logger.info("Service initialized!")
+    return app
 
-try:
-    models.init_db(app)  # make our SQLAlchemy tables
-except Exception as error:
-    app.logger.critical("%s: Cannot continue", error)
-    # gunicorn requires exit code 4 to stop spawning workers when they die
-    sys.exit(4)
 
-app.logger.info("Service initialized!")
+create_app()
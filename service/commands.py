@@ -0,0 +1,150 @@
+"""
+Commands
+
+This module contains the Flask CLI commands used to maintain the
+inventory database, e.g.:
+  flask inventory create-schema
+  flask inventory rebuild-summary --verify-only
+  flask inventory recompute-restock-levels --product-id 42
+  flask inventory seed --rows 1000000
+  flask inventory export --format csv --gzip --output inventory.csv.gz
+"""
+import random
+import time
+from itertools import islice
+import click
+from flask.cli import AppGroup
+from service.dataset import generate_inventories, batches
+from service.export import FORMATS, export_chunks
+from service.models import (
+    db, Inventory, InventorySummary, RestockThreshold, DataValidationError, create_schema,
+)
+from . import app
+
+inventory_cli = AppGroup("inventory", help="Inventory maintenance commands.")
+
+
+######################################################################
+# CREATE THE DATABASE SCHEMA
+######################################################################
+@inventory_cli.command("create-schema")
+def create_schema_command():
+    """Create the missing tables and their initial rows"""
+    create_schema()
+    click.echo("Database schema is up to date")
+
+
+######################################################################
+# REBUILD THE INVENTORY SUMMARY
+######################################################################
+@inventory_cli.command("rebuild-summary")
+@click.option("--verify-only", is_flag=True,
+              help="Only compare the summary with the inventory table.")
+def rebuild_summary(verify_only):
+    """Recompute the inventory summary table and verify it"""
+    mismatches = InventorySummary.verify()
+    for condition, restock_level, expected, actual in mismatches:
+        click.echo(
+            f"{condition.name}/{restock_level.name}: (row_count, quantity_total) "
+            f"expected {expected}, found {actual}"
+        )
+    if verify_only:
+        if mismatches:
+            raise click.ClickException(f"{len(mismatches)} summary groups are out of date")
+        click.echo("Inventory summary is consistent")
+        return
+
+    InventorySummary.rebuild()
+    if InventorySummary.verify():
+        raise click.ClickException("Inventory summary still differs after the rebuild")
+    click.echo(f"Inventory summary rebuilt, {len(mismatches)} groups were corrected")
+
+
+######################################################################
+# RECOMPUTE THE RESTOCK LEVELS
+######################################################################
+@inventory_cli.command("recompute-restock-levels")
+@click.option("--product-id", type=int, default=None,
+              help="Only recompute the inventories of this product.")
+def recompute_restock_levels(product_id):
+    """Derive restock_level again from the quantity thresholds"""
+    changed = Inventory.recompute_restock_levels(product_id)
+    click.echo(f"{changed} restock levels changed")
+
+
+######################################################################
+# SEED SYNTHETIC INVENTORIES
+######################################################################
+@inventory_cli.command("seed")
+@click.option("--rows", type=int, default=1000, show_default=True,
+              help="Number of inventories to add.")
+@click.option("--batch-size", type=int, default=100000, show_default=True,
+              help="Inventories loaded per COPY and transaction.")
+@click.option("--seed", "random_seed", type=int, default=None,
+              help="Seed of the generator, for repeatable datasets.")
+def seed(rows, batch_size, random_seed):
+    """Add synthetic inventories of new products with COPY"""
+    if rows < 0 or batch_size < 1:
+        raise click.BadParameter("--rows must not be negative and --batch-size must be positive")
+    # start past every product that has inventories or thresholds
+    first_product_id = 1 + max(
+        db.session.query(db.func.max(Inventory.product_id)).scalar() or 0,
+        db.session.query(db.func.max(RestockThreshold.product_id)).scalar() or 0,
+    )
+    thresholds = app.config["RESTOCK_LEVEL_THRESHOLDS"] if app.config["RESTOCK_LEVEL_DERIVED"] else None
+    inventories = generate_inventories(first_product_id, thresholds, random.Random(random_seed))
+
+    started = time.perf_counter()
+    loaded = 0
+    for batch in batches(islice(inventories, rows), batch_size):
+        loaded += Inventory.copy_rows(batch)
+        click.echo(f"{loaded} of {rows} inventories loaded")
+    elapsed = time.perf_counter() - started
+    click.echo(f"Seeded {loaded} inventories from product {first_product_id} "
+               f"in {elapsed:.1f}s ({loaded / max(elapsed, 1e-9):,.0f} rows/sec)")
+
+
+######################################################################
+# EXPORT THE INVENTORIES
+######################################################################
+@inventory_cli.command("export")
+@click.option("--format", "export_format", type=click.Choice(list(FORMATS)),
+              default="csv", show_default=True, help="Format of the dump.")
+@click.option("--gzip", "compress", is_flag=True, help="Compress the dump with gzip.")
+@click.option("--output", default="-", show_default=True,
+              help="File to write the dump to, - for stdout.")
+@click.option("--condition", default=None, help="Comma separated conditions.")
+@click.option("--restock-level", default=None, help="Comma separated restock levels.")
+@click.option("--product-id", default=None, help="Comma separated product IDs.")
+@click.option("--quantity-min", type=int, default=None, help="Smallest quantity exported.")
+@click.option("--quantity-max", type=int, default=None, help="Largest quantity exported.")
+@click.option("--sort", type=click.Choice(Inventory.SORT_ORDERS), default="inventory_id",
+              show_default=True, help="Order of the rows.")
+def export(export_format, compress, output, sort, **filters):
+    """Stream the inventories matching the filters as CSV or JSON Lines"""
+    req_dict = {key: value for key, value in filters.items() if value is not None}
+    try:
+        Inventory.build_filters(req_dict)
+    except (DataValidationError, KeyError, ValueError) as error:
+        raise click.BadParameter(f"Invalid filter: {error}") from error
+
+    started = time.perf_counter()
+    exported = 0
+
+    def counted(rows):
+        nonlocal exported
+        for row in rows:
+            exported += 1
+            yield row
+
+    chunk_size = app.config["STREAM_CHUNK_SIZE"]
+    rows = counted(Inventory.iter_rows(req_dict, chunk_size, sort))
+    with click.open_file(output, "wb") as file:
+        for data in export_chunks(rows, export_format, chunk_size, compress):
+            file.write(data)
+    db.session.commit()
+    elapsed = time.perf_counter() - started
+    click.echo(f"Exported {exported} inventories in {elapsed:.1f}s", err=True)
+
+
+app.cli.add_command(inventory_cli)
@@ -0,0 +1,69 @@
+"""
+Dataset
+
+Generates synthetic inventories for test and performance environments,
+e.g. through: flask inventory seed --rows 1000000
+
+The distributions are the ones tests.factory.InventoryFactory uses.
+"""
+import random
+from itertools import islice
+from service.models import Condition, RestockLevel
+
+CONDITIONS = [
+    Condition.NEW,
+    Condition.OPEN_BOX,
+    Condition.USED,
+]
+RESTOCK_LEVELS = [
+    RestockLevel.EMPTY,
+    RestockLevel.LOW,
+    RestockLevel.MODERATE,
+    RestockLevel.PLENTY,
+]
+QUANTITY_RANGE = (10, 5000)
+
+
+def restock_level_of(quantity, thresholds) -> RestockLevel:
+    """Returns the restock level of a quantity, see RESTOCK_LEVEL_THRESHOLDS"""
+    low, moderate, plenty = thresholds
+    if quantity >= plenty:
+        return RestockLevel.PLENTY
+    if quantity >= moderate:
+        return RestockLevel.MODERATE
+    if quantity >= low:
+        return RestockLevel.LOW
+    return RestockLevel.EMPTY
+
+
+def generate_inventories(first_product_id, thresholds=None, rng=random):
+    """Yields inventories with consecutive product_ids without end
+
+    :param first_product_id: the product_id of the first inventory
+    :type first_product_id: int
+    :param thresholds: derive the restock level from the quantity
+    with these thresholds instead of picking one
+    :type thresholds: tuple
+
+    :return: (product_id, condition, restock_level, quantity) tuples
+    :rtype: iterator
+    """
+    low, high = QUANTITY_RANGE
+    product_id = first_product_id
+    while True:
+        quantity = rng.randint(low, high)
+        if thresholds:
+            restock_level = restock_level_of(quantity, thresholds)
+        else:
+            restock_level = rng.choice(RESTOCK_LEVELS)
+        yield product_id, rng.choice(CONDITIONS), restock_level, quantity
+        product_id += 1
+
+
+def batches(iterator, size):
+    """Yields lists of up to size items of the iterator"""
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
@@ -0,0 +1,269 @@
+"""
+Events
+
+Streams the quantity and restock level changes of the inventories to
+the clients of GET /api/events as Server-Sent Events.
+
+Every write transaction publishes its changes with NOTIFY, see
+models.publish_events(). Each worker LISTENs on one connection of its
+own from a background thread, which only runs while the worker has
+streams open, and hands every event to the subscriptions whose filters
+match it. A subscription buffers at most SSE_CLIENT_BUFFER events: a
+client that falls further behind is sent an overflow event and
+disconnected, so a slow client never grows the memory of the worker.
+"""
+import json
+import logging
+import queue
+import select
+import threading
+import time
+import psycopg2
+from psycopg2.extensions import quote_ident
+from service import app
+from service.models import Condition, RestockLevel, db, to_enum
+
+logger = logging.getLogger(__name__)
+
+# Seconds the listener waits before it connects again after an error
+RECONNECT_DELAY = 1.0
+
+
+class TooManySubscribersError(Exception):
+    """Used when a worker already serves SSE_MAX_CLIENTS streams"""
+
+
+def parse_list(value, convert) -> set:
+    """Returns the set of converted values of a comma separated list, or None"""
+    if value is None or value == '':
+        return None
+    return {convert(item) for item in str(value).split(',')}
+
+
+class Subscription:
+    """
+    The filters and the bounded buffer of one event stream
+
+    A change is sent as a restock_level event when it moves the
+    inventory to another restock level, and as a quantity event when
+    its quantity crosses quantity_below in either direction.
+    """
+
+    def __init__(self, conditions=None, product_ids=None, restock_levels=None,
+                 quantity_below=None, buffer_size=100, since=0):
+        self.conditions = conditions
+        self.product_ids = product_ids
+        self.restock_levels = restock_levels
+        self.quantity_below = quantity_below
+        self.events = queue.Queue(buffer_size)
+        self.overflowed = False
+        # a change feed cursor the client can resync from after an overflow
+        self.since = since
+
+    @classmethod
+    def from_args(cls, req_dict, buffer_size, since=0):
+        """Creates a Subscription from the query parameters of a stream
+
+        :param req_dict: condition, product_id and restock_level as comma
+        separated lists and quantity_below
+        :type req_dict: dict
+        """
+        return cls(
+            conditions=parse_list(req_dict.get('condition'),
+                                  lambda item: to_enum(Condition, item).name),
+            product_ids=parse_list(req_dict.get('product_id'), int),
+            restock_levels=parse_list(req_dict.get('restock_level'),
+                                      lambda item: to_enum(RestockLevel, item).name),
+            quantity_below=req_dict.get('quantity_below'),
+            buffer_size=buffer_size,
+            since=since,
+        )
+
+    def event_type(self, event):
+        """Returns the name this subscription sends an event under, or None"""
+        if "resync" in event:
+            return "resync"
+        if self.conditions is not None and event["condition"] not in self.conditions:
+            return None
+        if self.product_ids is not None and event["product_id"] not in self.product_ids:
+            return None
+        if event["old_restock_level"] != event["restock_level"] and (
+                self.restock_levels is None or event["restock_level"] in self.restock_levels):
+            return "restock_level"
+        if self.quantity_below is not None and event["quantity"] is not None:
+            was_below = event["old_quantity"] is not None and event["old_quantity"] < self.quantity_below
+            if was_below != (event["quantity"] < self.quantity_below):
+                return "quantity"
+        return None
+
+    def offer(self, name, event) -> bool:
+        """Buffers an event without blocking, False when the buffer was full"""
+        if self.overflowed:
+            return False
+        try:
+            self.events.put_nowait((name, event))
+            return True
+        except queue.Full:
+            self.overflowed = True
+            return False
+
+    def next_event(self, timeout):
+        """Returns the next (name, event), or None when timeout passed without one"""
+        try:
+            name, event = self.events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        # every change up to the watermark has reached the worker already
+        self.since = max(self.since, event["watermark"])
+        return name, event
+
+
+class EventBroker:
+    """Fans the NOTIFY events of one worker out to its subscriptions"""
+
+    def __init__(self, app, poll_interval=1.0):
+        self.app = app
+        self.poll_interval = poll_interval
+        self.subscriptions = set()
+        self._lock = threading.Lock()
+        self._thread = None
+        # set while the LISTEN connection is open
+        self.listening = threading.Event()
+        self.delivered = 0
+        self.overflows = 0
+
+    def subscribe(self, subscription):
+        """Adds a subscription and starts listening if the worker was not yet
+
+        :raises TooManySubscribersError: when SSE_MAX_CLIENTS streams are open
+        """
+        with self._lock:
+            if len(self.subscriptions) >= self.app.config["SSE_MAX_CLIENTS"]:
+                raise TooManySubscribersError(
+                    f"This worker already serves {len(self.subscriptions)} event streams")
+            self.subscriptions.add(subscription)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._listen, name="inventory-events", daemon=True)
+                self._thread.start()
+
+    def unsubscribe(self, subscription):
+        """Removes a subscription, the listener stops after the last one"""
+        with self._lock:
+            self.subscriptions.discard(subscription)
+
+    def dispatch(self, payload):
+        """Hands the event in a NOTIFY payload to the matching subscriptions"""
+        event = json.loads(payload)
+        with self._lock:
+            subscriptions = list(self.subscriptions)
+        for subscription in subscriptions:
+            name = subscription.event_type(event)
+            if name is None or subscription.overflowed:
+                continue
+            if subscription.offer(name, event):
+                self.delivered += 1
+            else:
+                self.overflows += 1
+                logger.warning("Event stream fell %d events behind, disconnecting it",
+                               subscription.events.maxsize)
+
+    def stats(self) -> dict:
+        """Returns the counters of the broker"""
+        return {
+            "subscriptions": len(self.subscriptions),
+            "listening": self.listening.is_set(),
+            "delivered": self.delivered,
+            "overflows": self.overflows,
+        }
+
+    def _has_subscriptions(self) -> bool:
+        """Returns True while streams are open, otherwise lets the listener stop"""
+        with self._lock:
+            if self.subscriptions:
+                return True
+            self._stopped()
+            return False
+
+    def _stopped(self):
+        """Forgets the listener of the calling thread, called with the lock held"""
+        if self._thread is threading.current_thread():
+            self._thread = None
+            self.listening.clear()
+
+    def _connect(self):
+        """Opens the LISTEN connection, outside of the pool of the primary"""
+        engine = db.get_engine(self.app)
+        cargs, cparams = engine.dialect.create_connect_args(engine.url)
+        connection = psycopg2.connect(*cargs, **cparams)
+        connection.autocommit = True
+        with connection.cursor() as cursor:
+            cursor.execute(f"LISTEN {quote_ident(self.app.config['EVENTS_CHANNEL'], connection)}")
+        return connection
+
+    def _listen(self):
+        """Delivers the notifications until the last subscription is gone"""
+        connection = None
+        try:
+            while self._has_subscriptions():
+                try:
+                    if connection is None:
+                        connection = self._connect()
+                        self.listening.set()
+                        logger.info("Listening for inventory events")
+                    if select.select([connection], [], [], self.poll_interval) == ([], [], []):
+                        continue
+                    connection.poll()
+                    while connection.notifies:
+                        self.dispatch(connection.notifies.pop(0).payload)
+                except (psycopg2.Error, OSError) as error:
+                    logger.error("Inventory event listener failed: %s", error)
+                    if connection is not None:
+                        self.listening.clear()
+                        connection.close()
+                        connection = None
+                        # the events sent while reconnecting are lost
+                        self.dispatch(json.dumps({"resync": 0, "version": 0, "watermark": 0}))
+                    time.sleep(RECONNECT_DELAY)
+        finally:
+            with self._lock:
+                self._stopped()
+            if connection is not None:
+                connection.close()
+
+
+def format_event(name, data, event_id=None) -> str:
+    """Returns one event in the text/event-stream format"""
+    lines = [f"event: {name}"]
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"data: {json.dumps(data)}")
+    return "\n".join(lines) + "\n\n"
+
+
+def stream_events(broker, subscription, keepalive):
+    """Yields the events of a subscription until it overflows or the client leaves
+
+    An idle stream is sent a comment every keepalive seconds, writing it
+    is how a closed connection is noticed.
+    """
+    try:
+        while True:
+            item = subscription.next_event(keepalive)
+            if subscription.overflowed:
+                yield format_event("overflow", {"since": str(subscription.since)})
+                return
+            if item is None:
+                yield ": keep-alive\n\n"
+                continue
+            name, event = item
+            event_id = None
+            if "inventory_id" in event:
+                event_id = f"{event['version']},{event['inventory_id']}"
+            yield format_event(name, event, event_id)
+    finally:
+        broker.unsubscribe(subscription)
+
+
+# the broker of this worker
+broker = EventBroker(app)
@@ -0,0 +1,81 @@
+"""
+Export
+
+Encodes the inventories as CSV or JSON Lines for full dumps, e.g.
+through GET /api/inventories/export or:
+  flask inventory export --format csv --gzip --output inventory.csv.gz
+
+The rows come from a server-side cursor, see Inventory.iter_rows(), and
+are encoded and compressed one chunk at a time, so memory use stays the
+same whatever the size of the table.
+"""
+import csv
+import io
+import json
+import zlib
+from service.models import DataValidationError
+
+# media type of every export format
+FORMATS = {
+    "csv": "text/csv",
+    "jsonl": "application/x-ndjson",
+}
+GZIP_MEDIA_TYPE = "application/gzip"
+# the columns of a CSV export, in this order
+CSV_COLUMNS = ("inventory_id", "product_id", "condition", "restock_level", "quantity", "version")
+
+
+def encode_rows(rows, export_format) -> str:
+    """Returns serialized inventories as lines of the export format"""
+    if export_format == "jsonl":
+        return "".join(json.dumps(row) + "\n" for row in rows)
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, CSV_COLUMNS, lineterminator="\n")
+    writer.writerows(rows)
+    return buffer.getvalue()
+
+
+def text_chunks(rows, export_format, chunk_size):
+    """Yields the text of an export, a CSV header first and then chunk_size rows at a time"""
+    if export_format == "csv":
+        yield ",".join(CSV_COLUMNS) + "\n"
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            yield encode_rows(chunk, export_format)
+            chunk = []
+    if chunk:
+        yield encode_rows(chunk, export_format)
+
+
+def encode_chunks(texts, compress=False):
+    """Yields texts as UTF-8 bytes, gzip compressed as one stream when compress is set"""
+    # wbits 16 + MAX_WBITS writes the gzip header and trailer
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS) if compress else None
+    for text in texts:
+        data = text.encode("utf-8")
+        if compressor:
+            data = compressor.compress(data)
+        if data:
+            yield data
+    if compressor:
+        yield compressor.flush()
+
+
+def export_chunks(rows, export_format, chunk_size, compress=False):
+    """Yields serialized inventories as bytes of the export format
+
+    :param rows: serialized inventories, e.g. from Inventory.iter_rows()
+    :type rows: iterable
+    :param export_format: one of FORMATS
+    :type export_format: str
+    :param chunk_size: the number of rows encoded per chunk
+    :type chunk_size: int
+    :param compress: gzip the chunks as one gzip stream
+    :type compress: bool
+    """
+    if export_format not in FORMATS:
+        raise DataValidationError(
+            f"Invalid format: {export_format}, expected one of {', '.join(FORMATS)}")
+    yield from encode_chunks(text_chunks(rows, export_format, chunk_size), compress)
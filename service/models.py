@@ -3,16 +3,54 @@ Models for Inventory
 
 All of the models are stored in this module
 """
+import io
+import json
 import logging
+import random
 from enum import IntEnum
-from flask_sqlalchemy import SQLAlchemy
+import psycopg2
+from flask import g, has_request_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import orm
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.exc import IntegrityError, DataError, StatementError
+from sqlalchemy.orm.exc import StaleDataError
 from . import app
+from .utils.cache import NullCache, make_cache
+
+# a child of app.logger, which is named after this package
+logger = logging.getLogger(__name__)
+
+# Bind keys of the read replicas in SQLALCHEMY_BINDS start with this prefix
+REPLICA_BIND_PREFIX = "replica"
+
+
+class RoutingSession(SignallingSession):
+    """
+    A session that sends the reads of a request to a read replica
+
+    Routing is switched on per request by use_read_replica(). Flushes
+    always go to the primary.
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        """Returns the replica chosen for this request, or the primary"""
+        if has_request_context() and not self._flushing:
+            replica = g.get("read_replica")
+            if replica is not None:
+                return replica
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """SQLAlchemy whose sessions can route reads to read replicas"""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
 
-logger = logging.getLogger("flask.app")
 
 # Create the SQLAlchemy object to be initialized later in init_db()
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 
 
 def init_db(app):
@@ -20,6 +58,154 @@ def init_db(app):
     Inventory.init_db(app)
 
 
+# Brings the tables of an older release up to date. create_all() only
+# creates missing tables, so every column added to an existing table
+# needs a statement here that can run more than once
+MIGRATIONS = (
+    "ALTER TABLE inventory ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT 0",
+)
+
+
+def create_schema():
+    """Creates the missing tables, migrates the existing ones and adds their initial rows"""
+    db.create_all()  # make our sqlalchemy tables
+    for statement in MIGRATIONS:
+        db.session.execute(db.text(statement))
+    db.session.commit()
+    create_indexes()
+    InventorySummary.init_summary()
+
+
+def create_indexes():
+    """Builds the indexes of the models that are missing on existing tables
+
+    CREATE INDEX CONCURRENTLY does not block the writes to a large table
+    but cannot run inside a transaction. A build that failed leaves an
+    invalid index, which IF NOT EXISTS would keep, so it is dropped first.
+    """
+    indexes = [index for table in db.Model.metadata.sorted_tables for index in table.indexes]
+    preparer = db.engine.dialect.identifier_preparer
+    with db.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        invalid = connection.execute(db.text(
+            "SELECT index_class.relname FROM pg_index"
+            " JOIN pg_class AS index_class ON index_class.oid = pg_index.indexrelid"
+            " WHERE NOT pg_index.indisvalid AND index_class.relname = ANY(:names)"
+        ), {"names": [index.name for index in indexes]}).scalars().all()
+        for name in invalid:
+            logger.warning("Dropping the invalid index %s", name)
+            connection.exec_driver_sql(f"DROP INDEX CONCURRENTLY IF EXISTS {preparer.quote(name)}")
+        for index in indexes:
+            columns = ", ".join(preparer.quote(column.name) for column in index.columns)
+            connection.exec_driver_sql(
+                f"CREATE {'UNIQUE ' if index.unique else ''}INDEX CONCURRENTLY IF NOT EXISTS "
+                f"{preparer.quote(index.name)} ON {preparer.format_table(index.table)} ({columns})"
+            )
+
+
+def dispose_engines(app):
+    """Drops the pooled connections a forked worker inherited from its parent
+
+    The connections stay open for the parent, the worker opens its own.
+    """
+    state = app.extensions.get("sqlalchemy")
+    if state is None:
+        return
+    for connector in list(state.connectors.values()):
+        connector.get_engine().dispose(close=False)
+
+
+def use_read_replica(consistency_token=None):
+    """Sends the reads of the current request to a read replica
+
+    The replica is only used when it has caught up with the write the
+    consistency token was issued for, otherwise the reads stay on the
+    primary.
+
+    :param consistency_token: the version of the write the reads must see
+    :type consistency_token: int
+
+    :return: the engine of the replica, or None to read from the primary
+    :rtype: Engine
+    """
+    bind_keys = [
+        key for key in app.config.get("SQLALCHEMY_BINDS") or {}
+        if key.startswith(REPLICA_BIND_PREFIX)
+    ]
+    if not bind_keys:
+        return None
+    replica = db.get_engine(app, bind=random.choice(bind_keys))
+    if consistency_token is not None:
+        seq = ChangeCounter.current(replica)
+        if seq < consistency_token:
+            logger.info("Replica is at change %s, reading change %s from the primary",
+                        seq, consistency_token)
+            return None
+    g.read_replica = replica
+    return replica
+
+
+def reading_from_replica() -> bool:
+    """Returns True when the current request reads from a read replica"""
+    return has_request_context() and g.get("read_replica") is not None
+
+
+def restock_event(inventory_id, product_id, condition, old_restock_level,
+                  restock_level, old_quantity, quantity, version) -> dict:
+    """Returns the event of one write to an Inventory
+
+    old_restock_level and old_quantity are None for a created Inventory,
+    restock_level and quantity are None for a deleted one.
+    """
+    def name(value):
+        return None if value is None else getattr(value, "name", value)
+
+    return {
+        "inventory_id": inventory_id,
+        "product_id": product_id,
+        "condition": name(condition),
+        "old_restock_level": name(old_restock_level),
+        "restock_level": name(restock_level),
+        "old_quantity": old_quantity,
+        "quantity": quantity,
+        "version": version,
+    }
+
+
+def publish_events(events):
+    """Sends the events of changed quantities and restock levels to the listeners
+
+    The NOTIFY is part of the current transaction, so the events are
+    delivered to every worker when it commits and never when it rolls
+    back. A transaction writing more than EVENTS_MAX_PER_TRANSACTION
+    rows sends a single resync event instead. Every event carries the
+    ChangeCounter watermark at its commit: the events of all changes up
+    to it were sent before it.
+
+    :param events: dictionaries made by restock_event()
+    :type events: iterable
+    """
+    if not app.config["EVENTS_ENABLED"]:
+        return
+    events = [
+        event for event in events
+        if event["old_restock_level"] != event["restock_level"]
+        or event["old_quantity"] != event["quantity"]
+    ]
+    if len(events) > app.config["EVENTS_MAX_PER_TRANSACTION"]:
+        payloads = [json.dumps({"resync": len(events), "version": events[0]["version"]})]
+    else:
+        payloads = [json.dumps(event) for event in events]
+    if payloads:
+        db.session.execute(
+            db.text(
+                "SELECT pg_notify(:channel, CAST(CAST(payload AS jsonb) || "
+                f"jsonb_build_object('watermark', {ChangeCounter.WATERMARK}) AS text)) "
+                "FROM unnest(CAST(:payloads AS text[])) AS payload"
+            ),
+            {"channel": app.config["EVENTS_CHANNEL"], "payloads": payloads},
+        )
+
+
 class DataValidationError(Exception):
     """Used for an data validation errors when deserializing"""
 
@@ -30,6 +216,14 @@ class DuplicateKeyValueError(Exception):
     duplicate keys error in create() function"""
 
 
+class StaleVersionError(Exception):
+    """Used when a record was changed by someone else since it was read"""
+
+
+class InsufficientQuantityError(Exception):
+    """Used when a quantity change would push the stock below zero"""
+
+
 class Condition(IntEnum):
     """Enumeration of condition of a valid Inventory"""
 
@@ -48,6 +242,14 @@ class RestockLevel(IntEnum):
     PLENTY = 3
 
 
+def to_enum(enum_cls, value):
+    """Converts a member, a member name or a numeric value into enum_cls"""
+    if isinstance(value, enum_cls):
+        return value
+    value = str(value)
+    return enum_cls(int(value)) if value.isnumeric() else enum_cls[value]
+
+
 ######################################################################
 #  P E R S I S T E N T   B A S E   M O D E L
 ######################################################################
@@ -56,6 +258,9 @@ class RestockLevel(IntEnum):
 class PersistentBase:
     """Base class added persistent methods"""
 
+    # read-through cache of the serialized records, set up in init_db()
+    cache = NullCache()
+
     def create(self):
         """
         Creates a record to the database
@@ -64,8 +269,16 @@ class PersistentBase:
         logger.info("Creating")
         # id must be none to generate next primary key
         self.id = None
+        if app.config["RESTOCK_LEVEL_DERIVED"]:
+            self.derive_restock_level()
         try:
+            self.version = ChangeCounter.version()
             db.session.add(self)
+            db.session.flush()
+            added = self.summary_change(1)
+            InventorySummary.apply([added])
+            publish_events([restock_event(self.inventory_id, self.product_id, added[0],
+                                          None, added[1], None, added[3], self.version)])
             db.session.commit()
         except IntegrityError as e:
             error = str(e.orig)
@@ -92,23 +305,64 @@ class PersistentBase:
         Updates a record to the database
         """
         logger.info("Updating %s", self.inventory_id)
+        removed = self.summary_change(-1, committed=True)
+        if app.config["RESTOCK_LEVEL_DERIVED"]:
+            self.derive_restock_level()
+        self.version = ChangeCounter.version()
+        self._flush_versioned()
+        # read after the flush, a derived restock_level is only known then
+        added = self.summary_change(1)
+        InventorySummary.apply([removed, added])
+        publish_events([restock_event(self.inventory_id, self.product_id, added[0],
+                                      removed[1], added[1], -removed[3], added[3], self.version)])
         db.session.commit()
+        self.cache.delete(self.inventory_id)
 
     def delete(self):
         """Removes a record from the data store"""
         logger.info("Deleting inventory_id:%s" % self.inventory_id)
+        version = ChangeCounter.version()
+        removed = self.summary_change(-1, committed=True)
+        InventorySummary.apply([removed])
+        # the versioned DELETE below fails unless it removes this very row
+        deleted = db.select(Inventory.inventory_id, Inventory.product_id, Inventory.condition).where(
+            Inventory.inventory_id == self.inventory_id).subquery()
+        db.session.execute(InventoryTombstone.record(version, deleted))
+        publish_events([restock_event(self.inventory_id, self.product_id, removed[0],
+                                      removed[1], None, -removed[3], None, version)])
         db.session.delete(self)
+        self._flush_versioned()
         db.session.commit()
+        self.cache.delete(self.inventory_id)
+
+    def _flush_versioned(self):
+        """Flushes a write that is guarded by the version the record was read at"""
+        try:
+            db.session.flush()
+        except StaleDataError as stale_error:
+            db.session.rollback()
+            self.cache.delete(self.inventory_id)
+            raise StaleVersionError(
+                f"Inventory with id '{self.inventory_id}' was changed "
+                "by another request, read it again and retry"
+            ) from stale_error
 
     @classmethod
-    def init_db(cls, app):
-        """Initializes the database session"""
-        logger.info("Initializing database")
+    def init_app(cls, app):
+        """Initializes the database session without connecting to the database"""
         cls.app = app
+        PersistentBase.cache = make_cache(app.config)
         # This is where we initialize SQLAlchemy from the Flask app
-        db.init_app(app)
+        if "sqlalchemy" not in app.extensions:
+            db.init_app(app)
+
+    @classmethod
+    def init_db(cls, app):
+        """Initializes the database session and creates the schema"""
+        logger.info("Initializing database")
+        cls.init_app(app)
         app.app_context().push()
-        db.create_all()  # make our sqlalchemy tables
+        create_schema()
 
     @classmethod
     def all(cls):
@@ -122,6 +376,67 @@ class PersistentBase:
         logger.info("Processing lookup for id %s ...", by_id)
         return cls.query.get(by_id)
 
+######################################################################
+#  C H A N G E   C O U N T E R   M O D E L
+######################################################################
+
+
+class ChangeCounter:
+    """
+    Versions of the inventory changes and their watermark
+
+    A write transaction versions its rows with its PostgreSQL transaction
+    ID. The IDs are handed out without a lock, so writers of different
+    rows never wait for each other, but in the order the transactions
+    start and not in the order they commit. Readers of the changes stop
+    at the watermark instead: every transaction with an ID below the
+    oldest one still running has ended, so no change up to the watermark
+    can appear later.
+    """
+    # the version below the oldest transaction of the database still running
+    WATERMARK = "pg_snapshot_xmin(pg_current_snapshot())::text::bigint - 1"
+
+    @classmethod
+    def version(cls) -> int:
+        """Returns the version of the writes of the current transaction
+
+        :return: the ID of the current transaction
+        :rtype: int
+        """
+        statement = db.text("SELECT pg_current_xact_id()::text::bigint")
+        seq = db.session.execute(statement).scalar_one()
+        if has_request_context():
+            # handed to the client as its consistency token
+            g.change_seq = seq
+        return seq
+
+    @classmethod
+    def current(cls, engine=None) -> int:
+        """Returns the watermark, no change up to it is still in flight
+
+        :param engine: read the watermark of this database instead
+        :type engine: Engine
+        """
+        statement = db.text(f"SELECT {cls.WATERMARK}")
+        if engine is None:
+            return db.session.execute(statement).scalar_one()
+        with engine.connect() as connection:
+            return connection.execute(statement).scalar_one()
+
+    @classmethod
+    def snapshot_tag(cls, scope="") -> str:
+        """Returns a tag of the set of committed transactions the reads see
+
+        The tag changes with every write transaction that ends, so two
+        reads with the same tag saw the same state of every table.
+
+        :param scope: hashed into the tag, e.g. the query the reads answer
+        :type scope: str
+        """
+        statement = db.text("SELECT md5(pg_current_snapshot()::text || :scope)")
+        return db.session.execute(statement, {"scope": scope}).scalar_one()
+
+
 ######################################################################
 #  I N V E N T O R Y   M O D E L
 ######################################################################
@@ -152,12 +467,36 @@ class Inventory(db.Model, PersistentBase):
         db.Integer, autoincrement=True,
         primary_key=True, nullable=False
     )
+    # ChangeCounter version of the last write to this row, every ORM
+    # UPDATE/DELETE is guarded by the version the row was read at
+    version = db.Column(db.BigInteger, nullable=False, server_default="0")
 
+    # find_by_attributes filters on any combination of product_id,
+    # condition, restock_level and quantity: every one of them leads
+    # one of these indexes (product_id leads the unique constraint)
     __table_args__ = (
         db.UniqueConstraint(
             'product_id', 'condition',
             name='unique_constraint_product_id_condition'
         ),
+        db.Index('ix_inventory_condition_restock_level', 'condition', 'restock_level'),
+        db.Index('ix_inventory_restock_level_quantity', 'restock_level', 'quantity'),
+        db.Index('ix_inventory_quantity', 'quantity'),
+        # the change feed reads the rows written after a version
+        db.Index('ix_inventory_version', 'version', 'inventory_id'),
+    )
+
+    # the write paths set the next version themselves from the ChangeCounter
+    __mapper_args__ = {
+        "version_id_col": version,
+        "version_id_generator": False,
+    }
+
+    # orders of the list endpoint, each backed by an index
+    SORT_ORDERS = (
+        "inventory_id", "-inventory_id",
+        "product_id", "-product_id",
+        "quantity", "-quantity",
     )
 
     def __repr__(self):
@@ -174,9 +513,63 @@ class Inventory(db.Model, PersistentBase):
             "condition": self.condition.name,
             "product_id": self.product_id,
             "restock_level": self.restock_level.name,
-            "quantity": self.quantity
+            "quantity": self.quantity,
+            "version": self.version
             }
 
+    def summary_change(self, sign, committed=False) -> tuple:
+        """Returns the InventorySummary change of adding or removing this record
+
+        :param sign: 1 when the record is added, -1 when it is removed
+        :type sign: int
+        :param committed: use the values last loaded from the database
+        instead of the current, possibly modified, ones
+        :type committed: bool
+
+        :return: a (condition, restock_level, count, quantity) change
+        :rtype: tuple
+        """
+        state = db.inspect(self)
+        values = {}
+        for attr in ("condition", "restock_level", "quantity"):
+            history = state.attrs[attr].history
+            if committed and history.deleted:
+                values[attr] = history.deleted[0]
+            else:
+                values[attr] = getattr(self, attr)
+        try:
+            return (
+                to_enum(Condition, values["condition"] or Condition.UNKNOWN),
+                to_enum(RestockLevel, values["restock_level"] or RestockLevel.EMPTY),
+                sign,
+                sign * int(values["quantity"] or 0),
+            )
+        except (KeyError, ValueError, TypeError) as error:
+            raise DataValidationError(
+                "Invalid Inventory: " + str(error)
+            ) from error
+
+    @classmethod
+    def row_columns(cls) -> list:
+        """Returns the columns of a plain inventory row
+
+        The enums are selected by name, so a row can be turned into
+        JSON without creating mapped instances or enum members.
+        """
+        return [
+            cls.inventory_id,
+            db.type_coerce(cls.condition, db.String).label("condition"),
+            cls.product_id,
+            db.type_coerce(cls.restock_level, db.String).label("restock_level"),
+            cls.quantity,
+            cls.version,
+        ]
+
+    @staticmethod
+    def serialize_row(row) -> dict:
+        """Serializes a row selected with row_columns() into a dictionary"""
+        return dict(row._mapping)
+
     def deserialize(self, data):
         """
         Deserializes a Inventory from a dictionary
@@ -206,19 +599,30 @@ class Inventory(db.Model, PersistentBase):
         """Update an Inventory from a dictionary
            while checking for bad cases when
            product_id or condition are being
-           updated.
+           updated, or when the data carries a
+           version other than the current one.
 
         :param data: A dictionary containing the resource data
         :type data: dict
         """
-        condition = str(data["condition"])
-        condition = Condition(int(condition)) if condition.isnumeric() else Condition[condition]
+        condition = to_enum(Condition, data["condition"])
         if self.product_id != int(data["product_id"]) or \
            self.condition != condition:
             raise DataValidationError(
                 "Invalid Product: product_id or "
                 "condition should not be updated"
             )
+        try:
+            version = None if data.get("version") is None else int(data["version"])
+        except (TypeError, ValueError) as error:
+            raise DataValidationError(
+                f"Invalid Inventory: version must be an integer, not {data['version']!r}"
+            ) from error
+        if version is not None and version != self.version:
+            raise StaleVersionError(
+                f"Inventory with id '{self.inventory_id}' is at version "
+                f"{self.version}, not {data['version']}"
+            )
         self.deserialize(data)
         return super().update()
 
@@ -226,6 +630,300 @@ class Inventory(db.Model, PersistentBase):
     # CLASS METHODS
     ##################################################
 
+    def derive_restock_level(self):
+        """Lets the next INSERT or UPDATE derive restock_level from the quantity"""
+        try:
+            quantity = int(self.quantity or 0)
+            product_id = int(self.product_id)
+        except (ValueError, TypeError) as error:
+            raise DataValidationError(
+                "Invalid Inventory: " + str(error)
+            ) from error
+        self.restock_level = self.restock_level_for(
+            db.literal(quantity), db.literal(product_id))
+
+    @classmethod
+    def restock_level_for(cls, quantity, product_id):
+        """Returns a SQL expression deriving the RestockLevel of a quantity
+
+        The thresholds of the product in RestockThreshold win over the
+        global RESTOCK_LEVEL_THRESHOLDS.
+
+        :param quantity: a column or an expression of the quantity
+        :type quantity: ColumnElement
+        :param product_id: a column or an expression of the product_id
+        :type product_id: ColumnElement
+
+        :return: a CASE expression over the thresholds
+        :rtype: ColumnElement
+        """
+        low, moderate, plenty = [
+            db.func.coalesce(
+                db.select(column).where(
+                    RestockThreshold.product_id == product_id
+                ).scalar_subquery(),
+                default,
+            )
+            for column, default in zip(
+                (RestockThreshold.low, RestockThreshold.moderate, RestockThreshold.plenty),
+                app.config["RESTOCK_LEVEL_THRESHOLDS"],
+            )
+        ]
+        return db.cast(
+            db.case(
+                (quantity >= plenty, RestockLevel.PLENTY.name),
+                (quantity >= moderate, RestockLevel.MODERATE.name),
+                (quantity >= low, RestockLevel.LOW.name),
+                else_=RestockLevel.EMPTY.name,
+            ),
+            cls.restock_level.type,
+        )
+
+    @classmethod
+    def locked_rows(cls, name, *clauses):
+        """Returns a CTE that locks the matching rows and returns them as they were
+
+        An UPDATE ... FROM a self-join re-reads only its target row after
+        waiting for a concurrent writer, the joined row keeps the version
+        of the statement snapshot. SELECT ... FOR UPDATE waits for the
+        writer and returns the latest version instead, so the values of
+        the CTE are the ones the UPDATE overwrites.
+        """
+        return db.select(cls.inventory_id, cls.restock_level).where(
+            *clauses).with_for_update(of=cls.__table__).cte(name)
+
+    @classmethod
+    def change_quantity(cls, product_id, condition, delta) -> dict:
+        """Atomically adds delta to the quantity of an Inventory
+
+        The change is a single UPDATE ... RETURNING that also recomputes
+        the restock_level, so concurrent changes never overwrite each other.
+
+        :param product_id: the product_id of the Inventory
+        :type product_id: int
+        :param condition: the condition of the Inventory
+        :type condition: Condition
+        :param delta: the amount to add, negative to remove stock
+        :type delta: int
+
+        :return: the serialized Inventory, or None when it does not exist
+        :rtype: dict
+        """
+        logger.info("Changing quantity of %s/%s by %s",
+                    product_id, condition, delta)
+        try:
+            product_id = int(product_id)
+            condition = to_enum(Condition, condition)
+        except (KeyError, ValueError, TypeError) as error:
+            raise DataValidationError(
+                "Invalid product_id or condition: " + str(error)
+            ) from error
+        if not isinstance(delta, int) or isinstance(delta, bool):
+            raise DataValidationError("delta must be an integer")
+
+        old = cls.locked_rows("old", cls.product_id == product_id, cls.condition == condition)
+        new_quantity = cls.quantity + delta
+        statement = cls.__table__.update().where(
+            cls.inventory_id == old.c.inventory_id,
+            new_quantity >= 0,
+        ).values(
+            quantity=new_quantity,
+            restock_level=cls.restock_level_for(new_quantity, cls.product_id),
+            version=ChangeCounter.version(),
+        ).returning(*cls.row_columns(), old.c.restock_level.label("old_restock_level"))
+        try:
+            row = db.session.execute(statement).first()
+        except (DataError, StatementError) as data_error:
+            db.session.rollback()
+            raise DataValidationError(
+                f"Changing the quantity by {delta} is out of range"
+            ) from data_error
+        if row:
+            inventory = cls.serialize_row(row)
+            old_restock_level = inventory.pop("old_restock_level")
+            InventorySummary.apply([
+                (condition, old_restock_level, -1, -(row.quantity - delta)),
+                (condition, RestockLevel[row.restock_level], 1, row.quantity),
+            ])
+            publish_events([restock_event(row.inventory_id, product_id, condition,
+                                          old_restock_level, row.restock_level,
+                                          row.quantity - delta, row.quantity, row.version)])
+            db.session.commit()
+            cls.cache.delete(row.inventory_id)
+            return inventory
+        db.session.rollback()
+
+        if cls.query.filter(cls.product_id == product_id,
+                            cls.condition == condition).count():
+            raise InsufficientQuantityError(
+                f"Changing the quantity by {delta} would "
+                f"push the stock below zero"
+            )
+        return None
+
+    @classmethod
+    def recompute_restock_levels(cls, product_id=None) -> int:
+        """Derives the restock_level of every row again from its quantity
+
+        This is a single set-based UPDATE of the rows whose level
+        changes, run after the thresholds changed. It commits the
+        current transaction.
+
+        :param product_id: only recompute the rows of this product
+        :type product_id: int
+
+        :return: the number of rows whose restock_level changed
+        :rtype: int
+        """
+        logger.info("Recomputing restock levels of product %s", product_id)
+        new_level = cls.restock_level_for(cls.quantity, cls.product_id)
+        clauses = [cls.restock_level != new_level]
+        if product_id is not None:
+            clauses.append(cls.product_id == product_id)
+        old = cls.locked_rows("old", *clauses)
+        statement = cls.__table__.update().where(
+            cls.inventory_id == old.c.inventory_id, cls.restock_level != new_level,
+        ).values(
+            restock_level=new_level,
+            version=ChangeCounter.version(),
+        ).returning(cls.inventory_id, cls.product_id, cls.condition, cls.quantity,
+                    cls.restock_level, cls.version,
+                    old.c.restock_level.label("old_restock_level"))
+        rows = db.session.execute(statement).all()
+        changes = []
+        for row in rows:
+            changes.append((row.condition, row.old_restock_level, -1, -row.quantity))
+            changes.append((row.condition, row.restock_level, 1, row.quantity))
+        InventorySummary.apply(changes)
+        publish_events(
+            restock_event(row.inventory_id, row.product_id, row.condition, row.old_restock_level,
+                          row.restock_level, row.quantity, row.quantity, row.version)
+            for row in rows
+        )
+        db.session.commit()
+        for row in rows:
+            cls.cache.delete(row.inventory_id)
+        return len(rows)
+
+    @classmethod
+    def create_batch(cls, records) -> list:
+        """Inserts a batch of records with a single multi-row INSERT
+
+        Records that collide with an existing product_id & condition
+        (or with an earlier record of the same batch) are skipped
+        instead of failing the whole batch.
+
+        :param records: dictionaries with product_id, condition,
+        restock_level and quantity
+        :type records: list
+
+        :return: the new inventory_id of every record,
+        or None where the record was a duplicate
+        :rtype: list
+        """
+        logger.info("Creating a batch of %d records", len(records))
+        rows = []
+        for record in records:
+            try:
+                rows.append({
+                    "product_id": int(record["product_id"]),
+                    "condition": to_enum(Condition, record["condition"]),
+                    "restock_level": to_enum(
+                        RestockLevel,
+                        record.get("restock_level", RestockLevel.EMPTY)),
+                    "quantity": int(record.get("quantity", 0)),
+                })
+            except (KeyError, ValueError, TypeError) as error:
+                raise DataValidationError(
+                    "Invalid Inventory in batch: " + str(error)
+                ) from error
+        if not rows:
+            return []
+
+        version = ChangeCounter.version()
+        for row in rows:
+            row["version"] = version
+            if app.config["RESTOCK_LEVEL_DERIVED"]:
+                row["restock_level"] = cls.restock_level_for(
+                    db.literal(row["quantity"]), db.literal(row["product_id"]))
+        statement = postgresql.insert(cls.__table__).values(rows)
+        statement = statement.on_conflict_do_nothing(
+            constraint="unique_constraint_product_id_condition"
+        ).returning(cls.inventory_id, cls.product_id, cls.condition,
+                    cls.restock_level, cls.quantity)
+        try:
+            created = {}
+            changes = []
+            events = []
+            for row in db.session.execute(statement):
+                created[(row.product_id, row.condition)] = row.inventory_id
+                changes.append((row.condition, row.restock_level, 1, row.quantity))
+                events.append(restock_event(row.inventory_id, row.product_id, row.condition,
+                                            None, row.restock_level, None, row.quantity, version))
+            InventorySummary.apply(changes)
+            publish_events(events)
+            db.session.commit()
+        except (DataError, StatementError) as data_error:
+            db.session.rollback()
+            raise DataValidationError(
+                "Fail to create the inventory batch due to "
+                "wrong field format"
+            ) from data_error
+
+        # the first record of a key wins, any repeat of it is a duplicate
+        return [
+            created.pop((row["product_id"], row["condition"]), None)
+            for row in rows
+        ]
+
+    @classmethod
+    def copy_rows(cls, rows) -> int:
+        """Loads new records with a single COPY
+
+        This is the fastest way to load many records and is used to seed
+        test environments. Unlike create_batch() a record that collides
+        with an existing product_id & condition fails the whole call.
+
+        :param rows: (product_id, condition, restock_level, quantity)
+        tuples of ints and enums
+        :type rows: iterable
+
+        :return: the number of records loaded
+        :rtype: int
+        """
+        version = ChangeCounter.version()
+        buffer = io.StringIO()
+        totals = {}
+        for product_id, condition, restock_level, quantity in rows:
+            buffer.write(f"{product_id},{condition.name},{restock_level.name},{quantity},{version}\n")
+            total = totals.setdefault((condition, restock_level), [0, 0])
+            total[0] += 1
+            total[1] += quantity
+        count = sum(total[0] for total in totals.values())
+        logger.info("Copying %d records", count)
+        buffer.seek(0)
+
+        cursor = db.session.connection().connection.cursor()
+        try:
+            cursor.copy_expert(
+                f"COPY {cls.__tablename__} (product_id, condition, restock_level, quantity, version) "
+                "FROM STDIN WITH (FORMAT csv)",
+                buffer,
+            )
+        except psycopg2.IntegrityError as integrity_error:
+            db.session.rollback()
+            raise DuplicateKeyValueError(
+                "Fail to copy the records due to a duplicate product_id & condition"
+            ) from integrity_error
+        finally:
+            cursor.close()
+        InventorySummary.apply(
+            (condition, restock_level, total[0], total[1])
+            for (condition, restock_level), total in totals.items()
+        )
+        db.session.commit()
+        return count
+
     @classmethod
     def find_by_condition(cls, condition: IntEnum) -> list:
         """Returns all of the Products in a condition
@@ -240,6 +938,85 @@ class Inventory(db.Model, PersistentBase):
         logger.info("Processing condition query for %s ...", condition)
         return cls.query.filter(cls.condition == condition)
 
+    @classmethod
+    def build_filters(cls, req_dict) -> list:
+        """Builds the SQL filter clauses for the given request parameters
+
+        condition, restock_level and product_id take a comma separated
+        list of values, quantity_min and quantity_max bound the quantity.
+
+        :param req_dict: dictionary of request parameters
+        :type req_dict: MultiDict
+
+        :return: a list of filter clauses for the known attributes
+        :rtype: list
+        """
+        filter_list = []
+
+        # Add query parameters into filter list,
+        # ignore invalid params and illegal values
+        for attr in ['condition', 'restock_level', 'quantity', 'product_id']:
+            value = req_dict.get(attr)
+            if value is None or value == '':
+                continue
+            if attr == 'condition':
+                values = [to_enum(Condition, item) for item in str(value).split(',')]
+            elif attr == 'restock_level':
+                values = [to_enum(RestockLevel, item) for item in str(value).split(',')]
+            elif attr == 'product_id':
+                values = [int(item) for item in str(value).split(',')]
+            else:
+                values = [int(value)]
+            column = getattr(cls, attr)
+            filter_list.append(column == values[0] if len(values) == 1 else column.in_(values))
+
+        quantity_min = req_dict.get('quantity_min')
+        if quantity_min is not None and quantity_min != '':
+            filter_list.append(cls.quantity >= int(quantity_min))
+        quantity_max = req_dict.get('quantity_max')
+        if quantity_max is not None and quantity_max != '':
+            filter_list.append(cls.quantity <= int(quantity_max))
+
+        return filter_list
+
+    @classmethod
+    def sort_keys(cls, sort=None) -> tuple:
+        """Returns the columns of a sort order and whether it is descending
+
+        Rows with the same value are ordered by inventory_id, so the
+        keys identify a row for keyset pagination.
+
+        :param sort: one of SORT_ORDERS, None for inventory_id
+        :type sort: str
+
+        :return: the key columns and True for a descending order
+        :rtype: tuple
+        """
+        sort = sort or 'inventory_id'
+        if sort not in cls.SORT_ORDERS:
+            raise DataValidationError(
+                f"Invalid sort: {sort}, expected one of {', '.join(cls.SORT_ORDERS)}")
+        name = sort.lstrip('-')
+        keys = [getattr(cls, name)]
+        if name != 'inventory_id':
+            keys.append(cls.inventory_id)
+        return keys, sort.startswith('-')
+
+    @classmethod
+    def cursor_of(cls, row, sort=None) -> str:
+        """Returns the keyset cursor of a serialized row for the sort order"""
+        keys, _ = cls.sort_keys(sort)
+        return ','.join(str(row[key.key]) for key in keys)
+
+    @classmethod
+    def parse_cursor(cls, after, sort=None) -> tuple:
+        """Returns the key values of a cursor made by cursor_of()"""
+        keys, _ = cls.sort_keys(sort)
+        values = tuple(int(value) for value in str(after).split(','))
+        if len(values) != len(keys):
+            raise DataValidationError(f"Invalid cursor: {after}")
+        return values
+
     @classmethod
     def find_by_attributes(cls, req_dict) -> list:
         """Returns all of the products correspond to given request parameters
@@ -253,23 +1030,300 @@ class Inventory(db.Model, PersistentBase):
         """
         app.logger.info(
             "Processing query with parameters %s ...", str(req_dict))
-        filter_list = []
+        return cls.query.filter(*cls.build_filters(req_dict))
 
-        # Add query parameters into filter list,
-        # ignore invalid params and illegal values
-        for attr in ['condition', 'restock_level', 'quantity', 'product_id']:
-            value = req_dict.get(attr)
-            if value:
-                value = str(value)
-                if attr == 'condition':
-                    value = Condition(int(value)) if value.isnumeric() else Condition[value]
-                elif attr == 'restock_level':
-                    value = RestockLevel(int(value)) if value.isnumeric() else RestockLevel[value]
-                else:
-                    value = int(value)
-                filter_list.append(getattr(cls, attr) == value)
-
-        return cls.query.filter(*filter_list)
+    @classmethod
+    def select_rows(cls, req_dict, limit=None, after=None, sort=None):
+        """Returns a Core SELECT of the plain rows matching the parameters
+
+        With a limit or an after cursor the rows form one keyset page
+        in the sort order, so every page costs the same as the first.
+
+        :param req_dict: dictionary of request parameters
+        :type req_dict: MultiDict
+        :param limit: the maximum number of rows selected
+        :type limit: int
+        :param after: the cursor_of() the last row of the previous page
+        :type after: str
+        :param sort: one of SORT_ORDERS
+        :type sort: str
+
+        :return: a SELECT of the row_columns()
+        :rtype: Select
+        """
+        keys, descending = cls.sort_keys(sort)
+        statement = db.select(*cls.row_columns()).where(
+            *cls.build_filters(req_dict))
+        if after is not None:
+            values = cls.parse_cursor(after, sort)
+            if len(keys) == 1:
+                last, cursor = keys[0], values[0]
+            else:
+                last, cursor = db.tuple_(*keys), db.tuple_(*values)
+            statement = statement.where(last < cursor if descending else last > cursor)
+        if limit is not None or after is not None or sort:
+            statement = statement.order_by(
+                *(key.desc() if descending else key for key in keys)).limit(limit)
+        return statement
+
+    @classmethod
+    def find_rows(cls, req_dict, limit=None, after=None, sort=None) -> list:
+        """Returns the serialized products matching the parameters
+
+        This is the read-only path: plain rows are selected and
+        serialized without hydrating Inventory instances.
+
+        :param req_dict: dictionary of request parameters
+        :type req_dict: MultiDict
+        :param limit: the maximum number of products returned
+        :type limit: int
+        :param after: the cursor_of() the last row of the previous page
+        :type after: str
+        :param sort: one of SORT_ORDERS
+        :type sort: str
+
+        :return: a list of serialized products
+        :rtype: list
+        """
+        logger.info("Processing row query with parameters %s ...", str(req_dict))
+        statement = cls.select_rows(req_dict, limit, after, sort)
+        return [cls.serialize_row(row) for row in db.session.execute(statement)]
+
+    @classmethod
+    def iter_rows(cls, req_dict, chunk_size, sort=None):
+        """Yields the serialized products matching the parameters
+
+        The rows are fetched from a server-side cursor chunk_size
+        rows at a time, so memory use does not grow with the result.
+
+        :param req_dict: dictionary of request parameters
+        :type req_dict: MultiDict
+        :param chunk_size: the number of rows fetched per round trip
+        :type chunk_size: int
+        :param sort: one of SORT_ORDERS
+        :type sort: str
+        """
+        logger.info("Streaming rows with parameters %s ...", str(req_dict))
+        # yield_per, not stream_results alone: without it Session.execute()
+        # fetches the whole result before returning the first row
+        statement = cls.select_rows(req_dict, sort=sort).execution_options(
+            yield_per=chunk_size)
+        for row in db.session.execute(statement):
+            yield cls.serialize_row(row)
+
+    @classmethod
+    def find_row(cls, by_id, use_cache=True) -> dict:
+        """Returns the serialized product with the given ID, or None
+
+        Lookups are read through the cache, which the write paths
+        invalidate after they commit. With use_cache False the row is
+        read from the database, and the cache is refilled with it.
+        """
+        if use_cache:
+            inventory = cls.cache.get(by_id)
+            if inventory is not None:
+                return inventory
+
+        logger.info("Processing row lookup for id %s ...", by_id)
+        generation = cls.cache.generation
+        statement = db.select(*cls.row_columns()).where(cls.inventory_id == by_id)
+        row = db.session.execute(statement).first()
+        if not row:
+            return None
+        inventory = cls.serialize_row(row)
+        if not reading_from_replica():
+            # a lagging replica would put an old version into the cache
+            cls.cache.set(by_id, inventory, generation)
+        return inventory
+
+    @classmethod
+    def summarize(cls, group_by, req_dict, product_id_min=None, product_id_max=None) -> list:
+        """Returns row counts and quantity totals grouped in the database
+
+        :param group_by: the attributes to group by,
+        condition and/or restock_level
+        :type group_by: list
+        :param req_dict: dictionary of request parameters
+        :type req_dict: MultiDict
+        :param product_id_min: the smallest product_id counted
+        :type product_id_min: int
+        :param product_id_max: the largest product_id counted
+        :type product_id_max: int
+
+        :return: one dictionary per group with its count and quantity
+        :rtype: list
+        """
+        logger.info("Processing summary by %s with parameters %s ...",
+                    group_by, str(req_dict))
+        for attr in group_by:
+            if attr not in ("condition", "restock_level"):
+                raise DataValidationError(
+                    f"Invalid summary: can not group by {attr}")
+        filter_list = cls.build_filters(req_dict)
+        if not filter_list and product_id_min is None and product_id_max is None:
+            return InventorySummary.totals(group_by)
+
+        columns = [getattr(cls, attr) for attr in group_by]
+        if product_id_min is not None:
+            filter_list.append(cls.product_id >= product_id_min)
+        if product_id_max is not None:
+            filter_list.append(cls.product_id <= product_id_max)
+
+        statement = db.select(
+            *[db.type_coerce(column, db.String).label(column.key) for column in columns],
+            db.func.count().label("count"),
+            db.func.coalesce(db.func.sum(cls.quantity), 0).label("quantity"),
+        ).where(*filter_list).group_by(*columns).order_by(*columns)
+        return [dict(row._mapping) for row in db.session.execute(statement)]
+
+    @classmethod
+    def delete_by_attributes(cls, req_dict, chunk_size=None) -> int:
+        """Deletes all of the products correspond to given request parameters
+
+        The rows are removed with a single filtered DELETE statement,
+        or with one DELETE per chunk of at most chunk_size rows when a
+        chunk_size is given. Every statement is committed on its own.
+
+        :param req_dict: dictionary of request parameters
+        :type req_dict: MultiDict
+        :param chunk_size: maximum number of rows removed per transaction
+        :type chunk_size: int
+
+        :return: the number of rows removed
+        :rtype: int
+        """
+        logger.info(
+            "Processing bulk delete with parameters %s ...", str(req_dict))
+        filter_list = cls.build_filters(req_dict)
+        if chunk_size is not None and chunk_size < 0:
+            raise DataValidationError("chunk_size must not be negative")
+
+        if not chunk_size:
+            return cls._delete_where(filter_list)
+
+        deleted = 0
+        while True:
+            chunk = db.select(cls.inventory_id).where(
+                *filter_list).limit(chunk_size)
+            count = cls._delete_where([cls.inventory_id.in_(chunk)])
+            deleted += count
+            if count < chunk_size:
+                return deleted
+
+    @classmethod
+    def _delete_where(cls, clauses) -> int:
+        """Deletes the rows matching clauses in one transaction
+
+        The removed rows are returned by the DELETE itself, so exactly
+        those get a tombstone and are invalidated in the cache. The
+        tombstones are inserted by the same statement, the filter is
+        only run once.
+        """
+        version = ChangeCounter.version()
+        deleted = cls.__table__.delete().where(*clauses).returning(
+            cls.inventory_id, cls.product_id, cls.condition, cls.restock_level, cls.quantity
+        ).cte("deleted")
+        tombstones = InventoryTombstone.record(version, deleted).cte("tombstones")
+        statement = db.select(deleted).add_cte(tombstones)
+        rows = db.session.execute(statement).all()
+        if not rows:
+            db.session.rollback()
+            return 0
+        InventorySummary.apply(
+            [(row.condition, row.restock_level, -1, -row.quantity) for row in rows])
+        publish_events(
+            restock_event(row.inventory_id, row.product_id, row.condition, row.restock_level,
+                          None, row.quantity, None, version)
+            for row in rows
+        )
+        db.session.commit()
+        inventory_ids = [row.inventory_id for row in rows]
+        for inventory_id in inventory_ids:
+            cls.cache.delete(inventory_id)
+        return len(inventory_ids)
+
+    @classmethod
+    def parse_change_cursor(cls, since) -> tuple:
+        """Returns the (version, inventory_id) of a change feed cursor
+
+        A cursor is either the change sequence the client has seen all
+        changes of, or "version,inventory_id" of the last change it saw
+        when a page ended inside the changes of one transaction.
+        """
+        if since is None or since == '':
+            return 0, None
+        try:
+            values = [int(value) for value in str(since).split(',')]
+        except ValueError as error:
+            raise DataValidationError(f"Invalid change cursor: {since}") from error
+        if len(values) == 1:
+            return values[0], None
+        if len(values) == 2:
+            return values[0], values[1]
+        raise DataValidationError(f"Invalid change cursor: {since}")
+
+    @staticmethod
+    def select_changes(model, seen, after_id, upto, limit):
+        """Returns a SELECT of the rows of model written after a change cursor
+
+        :param model: Inventory or InventoryTombstone
+        :type model: db.Model
+        :param seen: the version of the cursor
+        :type seen: int
+        :param after_id: the inventory_id of the cursor, None after the whole version
+        :type after_id: int
+        :param upto: the last version selected
+        :type upto: int
+        :param limit: the maximum number of rows selected
+        :type limit: int
+
+        :return: a SELECT of the row_columns() of model
+        :rtype: Select
+        """
+        if after_id is None:
+            after = model.version > seen
+        else:
+            after = db.tuple_(model.version, model.inventory_id) > db.tuple_(seen, after_id)
+        return db.select(*model.row_columns()).where(after, model.version <= upto).order_by(
+            model.version, model.inventory_id).limit(limit)
+
+    @classmethod
+    def find_changes(cls, since=None, limit=1000) -> tuple:
+        """Returns the Inventories changed and deleted after a cursor
+
+        Both the rows and the tombstones are read through their
+        (version, inventory_id) index, so a call costs the number of
+        changes returned and not the size of the table. A row changed
+        several times is returned once, at its latest version.
+
+        :param since: a cursor from a previous call, None for everything
+        :type since: str
+        :param limit: the maximum number of changes returned
+        :type limit: int
+
+        :return: the changes in (version, inventory_id) order, the cursor
+        of the next call and whether more changes are waiting
+        :rtype: tuple
+        """
+        seen, after_id = cls.parse_change_cursor(since)
+        # the watermark is read first: no change up to it is in flight,
+        # so both SELECTs below see the same complete set of changes
+        upto = ChangeCounter.current()
+        logger.info("Processing changes after %s up to %s ...", since, upto)
+
+        changes = []
+        for model, deleted in ((cls, False), (InventoryTombstone, True)):
+            statement = cls.select_changes(model, seen, after_id, upto, limit + 1)
+            for row in db.session.execute(statement):
+                changes.append(dict(row._mapping, deleted=deleted))
+        changes.sort(key=lambda change: (change["version"], change["inventory_id"]))
+
+        if len(changes) > limit:
+            changes = changes[:limit]
+            last = changes[-1]
+            return changes, f"{last['version']},{last['inventory_id']}", True
+        # a lagging replica must not move the client backwards
+        return changes, str(max(upto, seen)), False
 
     # @classmethod
     # def find_by_inventory_id(cls, inventory_id) -> list:
@@ -318,3 +1372,260 @@ class Inventory(db.Model, PersistentBase):
         return cls.query.filter(
             cls.restock_level == restock_level, cls.condition == condition
         )
+
+
+######################################################################
+#  I N V E N T O R Y   T O M B S T O N E   M O D E L
+######################################################################
+
+
+class InventoryTombstone(db.Model):
+    """
+    An Inventory that was deleted, kept for the change feed
+
+    Every delete path records the removed rows here in the same
+    transaction, at the version of the delete.
+    """
+    __tablename__ = "inventory_tombstone"
+    inventory_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    product_id = db.Column(db.Integer, nullable=False)
+    condition = db.Column(db.Enum(Condition), nullable=False)
+    version = db.Column(db.BigInteger, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_inventory_tombstone_version', 'version', 'inventory_id'),
+    )
+
+    @classmethod
+    def row_columns(cls) -> list:
+        """Returns the columns of a plain tombstone row"""
+        return [
+            cls.inventory_id,
+            db.type_coerce(cls.condition, db.String).label("condition"),
+            cls.product_id,
+            cls.version,
+        ]
+
+    @classmethod
+    def record(cls, version, deleted):
+        """Returns the INSERT that records deleted Inventories at version
+
+        :param version: the ChangeCounter version of the delete
+        :type version: int
+        :param deleted: the deleted rows with their inventory_id, product_id
+        and condition, e.g. a CTE of the DELETE ... RETURNING
+        :type deleted: FromClause
+        """
+        rows = db.select(
+            deleted.c.inventory_id, deleted.c.product_id, deleted.c.condition,
+            db.literal(version, db.BigInteger),
+        )
+        statement = postgresql.insert(cls.__table__).from_select(
+            ["inventory_id", "product_id", "condition", "version"], rows)
+        return statement.on_conflict_do_update(
+            index_elements=[cls.inventory_id],
+            set_={
+                "product_id": statement.excluded.product_id,
+                "condition": statement.excluded.condition,
+                "version": statement.excluded.version,
+            },
+        )
+
+
+######################################################################
+#  R E S T O C K   T H R E S H O L D   M O D E L
+######################################################################
+
+
+class RestockThreshold(db.Model):
+    """
+    Per-product quantity thresholds of the restock levels
+
+    A quantity below low is EMPTY, from low it is LOW, from moderate
+    MODERATE and from plenty PLENTY. Products without a row use the
+    global RESTOCK_LEVEL_THRESHOLDS.
+    """
+    __tablename__ = "restock_threshold"
+    product_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    low = db.Column(db.Integer, nullable=False)
+    moderate = db.Column(db.Integer, nullable=False)
+    plenty = db.Column(db.Integer, nullable=False)
+
+    def serialize(self) -> dict:
+        """Serializes a RestockThreshold into a dictionary"""
+        return {
+            "product_id": self.product_id,
+            "low": self.low,
+            "moderate": self.moderate,
+            "plenty": self.plenty
+            }
+
+    @classmethod
+    def find(cls, product_id):
+        """Finds the thresholds of a product"""
+        logger.info("Processing threshold lookup for product %s ...", product_id)
+        return cls.query.get(product_id)
+
+    @classmethod
+    def save(cls, product_id, data):
+        """Creates or replaces the thresholds of a product
+
+        The restock levels of the product are recomputed in the same
+        transaction.
+
+        :param product_id: the product the thresholds apply to
+        :type product_id: int
+        :param data: a dictionary with low, moderate and plenty
+        :type data: dict
+
+        :return: the saved thresholds
+        :rtype: RestockThreshold
+        """
+        try:
+            values = {key: int(data[key]) for key in ("low", "moderate", "plenty")}
+        except KeyError as key_error:
+            raise DataValidationError(
+                "Invalid Threshold: missing " + key_error.args[0]
+            ) from key_error
+        except (TypeError, ValueError) as error:
+            raise DataValidationError(
+                "Invalid Threshold: body of request contained bad or no data"
+            ) from error
+        if not 0 <= values["low"] <= values["moderate"] <= values["plenty"]:
+            raise DataValidationError(
+                "Invalid Threshold: expected 0 <= low <= moderate <= plenty")
+
+        logger.info("Saving thresholds %s of product %s", values, product_id)
+        statement = postgresql.insert(cls.__table__).values(product_id=product_id, **values)
+        statement = statement.on_conflict_do_update(
+            index_elements=[cls.product_id], set_=values)
+        db.session.execute(statement)
+        Inventory.recompute_restock_levels(product_id)
+        return cls.find(product_id)
+
+    @classmethod
+    def remove(cls, product_id):
+        """Removes the thresholds of a product, which falls back to the global ones"""
+        logger.info("Removing thresholds of product %s", product_id)
+        db.session.execute(cls.__table__.delete().where(cls.product_id == product_id))
+        Inventory.recompute_restock_levels(product_id)
+
+
+######################################################################
+#  I N V E N T O R Y   S U M M A R Y   M O D E L
+######################################################################
+
+
+class InventorySummary(db.Model):
+    """
+    Row counts and quantity totals of the inventory per
+    condition & restock_level
+
+    Every write path applies its changes to this table in the same
+    transaction as the inventory rows, so unfiltered summaries never
+    have to scan the inventory table.
+    """
+    __tablename__ = "inventory_summary"
+    condition = db.Column(db.Enum(Condition), primary_key=True)
+    restock_level = db.Column(db.Enum(RestockLevel), primary_key=True)
+    row_count = db.Column(db.BigInteger, nullable=False, default=0)
+    quantity_total = db.Column(db.BigInteger, nullable=False, default=0)
+
+    @classmethod
+    def init_summary(cls):
+        """Builds the summary if it has never been built"""
+        if db.session.execute(db.select(cls.condition).limit(1)).first() is None:
+            cls.rebuild()
+
+    @classmethod
+    def apply(cls, changes):
+        """Adds changes to the summary inside the current transaction
+
+        :param changes: (condition, restock_level, count, quantity) tuples
+        :type changes: list
+        """
+        totals = {}
+        for condition, restock_level, count, quantity in changes:
+            total = totals.setdefault((condition, restock_level), [0, 0])
+            total[0] += count
+            total[1] += quantity
+        rows = [
+            {"condition": condition, "restock_level": restock_level,
+             "row_count": count, "quantity_total": quantity}
+            for (condition, restock_level), (count, quantity) in sorted(totals.items())
+            if count or quantity
+        ]
+        if not rows:
+            return
+        statement = postgresql.insert(cls.__table__).values(rows)
+        statement = statement.on_conflict_do_update(
+            index_elements=[cls.condition, cls.restock_level],
+            set_={
+                "row_count": cls.row_count + statement.excluded.row_count,
+                "quantity_total": cls.quantity_total + statement.excluded.quantity_total,
+            },
+        )
+        db.session.execute(statement)
+
+    @classmethod
+    def totals(cls, group_by) -> list:
+        """Returns the counts and quantities grouped like Inventory.summarize()"""
+        columns = [getattr(cls, attr) for attr in group_by]
+        statement = db.select(
+            *[db.type_coerce(column, db.String).label(column.key) for column in columns],
+            db.func.coalesce(db.func.sum(cls.row_count), 0).label("count"),
+            db.func.coalesce(db.func.sum(cls.quantity_total), 0).label("quantity"),
+        ).where(cls.row_count > 0).group_by(*columns).order_by(*columns)
+        return [
+            {key: int(value) if key in ("count", "quantity") else value
+             for key, value in row._mapping.items()}
+            for row in db.session.execute(statement)
+        ]
+
+    @classmethod
+    def _base_totals_select(cls):
+        """Returns a SELECT of the summary computed from the inventory table"""
+        return db.select(
+            Inventory.condition,
+            Inventory.restock_level,
+            db.func.count().label("row_count"),
+            db.func.coalesce(db.func.sum(Inventory.quantity), 0).label("quantity_total"),
+        ).group_by(Inventory.condition, Inventory.restock_level)
+
+    @classmethod
+    def verify(cls) -> list:
+        """Compares the summary with the inventory table
+
+        :return: (condition, restock_level, expected, actual) for every
+        group whose (row_count, quantity_total) differ
+        :rtype: list
+        """
+        expected = {
+            (row.condition, row.restock_level): (row.row_count, row.quantity_total)
+            for row in db.session.execute(cls._base_totals_select())
+        }
+        actual = {
+            (row.condition, row.restock_level): (row.row_count, row.quantity_total)
+            for row in db.session.execute(db.select(cls.__table__))
+            if row.row_count or row.quantity_total
+        }
+        return [
+            (condition, restock_level,
+             expected.get((condition, restock_level), (0, 0)),
+             actual.get((condition, restock_level), (0, 0)))
+            for condition, restock_level in sorted(set(expected) | set(actual))
+            if expected.get((condition, restock_level)) != actual.get((condition, restock_level))
+        ]
+
+    @classmethod
+    def rebuild(cls):
+        """Recomputes the whole summary from the inventory table"""
+        logger.info("Rebuilding the inventory summary")
+        # keeps the writers out during the rebuild, after the running ones committed
+        db.session.execute(db.text(f"LOCK TABLE {Inventory.__tablename__} IN SHARE MODE"))
+        db.session.execute(cls.__table__.delete())
+        db.session.execute(cls.__table__.insert().from_select(
+            ["condition", "restock_level", "row_count", "quantity_total"],
+            cls._base_totals_select(),
+        ))
+        db.session.commit()
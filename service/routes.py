@@ -12,14 +12,32 @@ Describe what your service does here
 # # IMPORT DEPENDENCIES
 # ######################################################################
 
-from flask import jsonify, request, make_response, abort
-from flask_restx import Resource, fields, reqparse
-from service.models import Inventory, RestockLevel, Condition
+import json
+from flask import jsonify, request, make_response, abort, Response, stream_with_context, g
+from flask_restx import Resource, fields, inputs, reqparse
+from jsonschema import Draft4Validator
+from prometheus_client import CONTENT_TYPE_LATEST
+from werkzeug.http import quote_etag
+from service.models import (
+    Inventory, RestockLevel, Condition, DataValidationError, ChangeCounter, RestockThreshold, db,
+    use_read_replica,
+)
+from service.events import Subscription, broker, stream_events
+from service.export import FORMATS as EXPORT_FORMATS, GZIP_MEDIA_TYPE, export_chunks
 from .utils import status  # HTTP Status Codes
+from .utils.metrics import generate_metrics
 # Import Flask application
 from . import app, api
 
 
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+EVENT_STREAM_MEDIA_TYPE = "text/event-stream"
+# Returned after a write, sent back to read that write from a replica
+CONSISTENCY_TOKEN_HEADER = "X-Consistency-Token"
+# range of the integer columns, a value outside fails the whole INSERT
+INT4_MIN, INT4_MAX = -2**31, 2**31 - 1
+
+
 ######################################################################
 # GET INDEX
 ######################################################################
@@ -32,7 +50,7 @@ def index():
 
 # define models so that the docs reflect what can be sent
 create_model = api.model("Inventory", {
-    "product_id": fields.Integer(required=True,
+    "product_id": fields.Integer(required=True, min=INT4_MIN, max=INT4_MAX,
                                  description="The product id for the inventory item"),
     "condition": fields.String(required=True,
                                enum=Condition._member_names_,
@@ -40,7 +58,7 @@ create_model = api.model("Inventory", {
     "restock_level": fields.String(required=True,
                                    enum=RestockLevel._member_names_,
                                    description="The restock level of the inventory item"),
-    "quantity": fields.Integer(required=True,
+    "quantity": fields.Integer(required=True, min=INT4_MIN, max=INT4_MAX,
                                default=0,
                                description="The quantity of items available")
 })
@@ -50,16 +68,87 @@ inventory_model = api.inherit(
     create_model,
     {
         "inventory_id": fields.Integer(readOnly=True,
-                                       description="The unique id assigned internally by service")
+                                       description="The unique id assigned internally by service"),
+        "version": fields.Integer(readOnly=True,
+                                  description="The version of the last write")
     }
 )
 
+threshold_model = api.model("RestockThreshold", {
+    "product_id": fields.Integer(readOnly=True,
+                                 description="The product the thresholds apply to"),
+    "low": fields.Integer(required=True, min=0,
+                          description="The minimum quantity of the LOW restock level"),
+    "moderate": fields.Integer(required=True, min=0,
+                               description="The minimum quantity of the MODERATE restock level"),
+    "plenty": fields.Integer(required=True, min=0,
+                             description="The minimum quantity of the PLENTY restock level")
+})
+
 inventory_args = reqparse.RequestParser()
 # 'condition', 'restock_level', 'quantity', 'product_id'
-inventory_args.add_argument('condition', type=str, required=False, help='List inventory by condition')
-inventory_args.add_argument('restock_level', type=str, required=False, help='List inventory by restock level')
+inventory_args.add_argument('condition', type=str, required=False,
+                            help='List inventory by comma separated conditions')
+inventory_args.add_argument('restock_level', type=str, required=False,
+                            help='List inventory by comma separated restock levels')
 inventory_args.add_argument('quantity', type=int, required=False, help='List inventory by quantity')
-inventory_args.add_argument('product_id', type=int, required=False, help='List inventory by product ID')
+inventory_args.add_argument('product_id', type=str, required=False,
+                            help='List inventory by comma separated product IDs')
+
+list_args = inventory_args.copy()
+list_args.add_argument('limit', type=int, required=False,
+                       help='Return at most this many inventories per page')
+list_args.add_argument('after', type=str, required=False,
+                       help='Return the inventories after this cursor from X-Next-Cursor')
+list_args.add_argument('quantity_min', type=int, required=False,
+                       help='List inventory with at least this quantity')
+list_args.add_argument('quantity_max', type=int, required=False,
+                       help='List inventory with at most this quantity')
+list_args.add_argument('sort', type=str, required=False, choices=Inventory.SORT_ORDERS,
+                       help='Order by this attribute, descending with a leading "-"')
+
+export_args = list_args.copy()
+export_args.remove_argument('limit')
+export_args.remove_argument('after')
+export_args.replace_argument('sort', type=str, required=False, default='inventory_id',
+                             choices=Inventory.SORT_ORDERS,
+                             help='Order by this attribute, descending with a leading "-"')
+export_args.add_argument('format', type=str, required=False, default='csv',
+                         choices=tuple(EXPORT_FORMATS), help='Format of the dump')
+export_args.add_argument('gzip', type=inputs.boolean, required=False, default=False,
+                         help='Compress the dump with gzip')
+
+summary_args = inventory_args.copy()
+summary_args.add_argument('group_by', type=str, required=False, default='condition,restock_level',
+                          help='Comma separated attributes to group by: condition, restock_level')
+summary_args.add_argument('product_id_min', type=int, required=False,
+                          help='Only count inventories with at least this product ID')
+summary_args.add_argument('product_id_max', type=int, required=False,
+                          help='Only count inventories with at most this product ID')
+
+bulk_args = reqparse.RequestParser()
+bulk_args.add_argument('batch_size', type=int, required=False, location='args',
+                       help='Number of inventories written per INSERT statement')
+
+changes_args = reqparse.RequestParser()
+changes_args.add_argument('since', type=str, required=False,
+                          help='Return the changes after this cursor from X-Next-Cursor')
+changes_args.add_argument('limit', type=int, required=False,
+                          help='Return at most this many changes')
+
+events_args = reqparse.RequestParser()
+events_args.add_argument('condition', type=str, required=False,
+                         help='Only send the events of these comma separated conditions')
+events_args.add_argument('product_id', type=str, required=False,
+                         help='Only send the events of these comma separated product IDs')
+events_args.add_argument('restock_level', type=str, required=False,
+                         help='Only send transitions into these comma separated restock levels')
+events_args.add_argument('quantity_below', type=int, required=False,
+                         help='Also send an event when the quantity crosses this threshold')
+
+clear_args = inventory_args.copy()
+clear_args.add_argument('chunk_size', type=int, required=False,
+                        help='Delete at most this many inventories per transaction')
 
 
 ######################################################################
@@ -103,27 +192,62 @@ class InventoryCollection(Resource):
     # LIST ALL INVENTORIES
     # ------------------------------------------------------------------
     @api.doc('list_inventories')
-    @api.expect(inventory_args, validate=True)
+    @api.expect(list_args, validate=True)
+    @api.produces(["application/json", NDJSON_MEDIA_TYPE])
+    @api.response(200, "Success", [inventory_model])
     @api.response(400, "Query parameters not valid")
-    @api.marshal_list_with(inventory_model)
     def get(self):
-        """Returns all of the Inventories"""
+        """Returns all of the Inventories
+
+        With limit or after the Inventories are returned in pages ordered
+        by sort (inventory_id by default), and the next page is linked in
+        the Link header.
+        With Accept: application/x-ndjson the rows are streamed as they
+        are fetched instead of being collected into one JSON list.
+        """
         app.logger.info("Request for Inventory list")
         inventories = []
+        headers = {'Vary': 'Accept'}
+        streaming = wants_ndjson()
 
         try:
-            req_dict = inventory_args.parse_args()
+            req_dict = list_args.parse_args()
             req_dict = {k: v for k, v in req_dict.items() if v is not None}
+            limit = req_dict.pop('limit', None)
+            after = req_dict.pop('after', None)
+            sort = req_dict.pop('sort', None)
+            # only a valid query is answered from its ETag
+            if limit is not None and limit < 1:
+                raise ValueError("limit must be positive")
+            Inventory.select_rows(req_dict, limit, after, sort)
+        except Exception:
+            abort(status.HTTP_400_BAD_REQUEST, "Query parameters not valid")
 
-            if len(req_dict) == 0:
-                inventories = Inventory.all()
+        # read the snapshot before the rows, a write committed in
+        # between then only makes the ETag older than the body
+        etag = list_etag(dict(req_dict, limit=limit, after=after, sort=sort), streaming)
+        if request.if_none_match.contains(etag):
+            response = not_modified(etag)
+            response.headers.update(headers)
+            return response
+
+        try:
+            if limit is not None or after is not None:
+                inventories, headers = list_page(req_dict, limit, after, sort)
+            elif streaming:
+                inventories = Inventory.iter_rows(
+                    req_dict, app.config["STREAM_CHUNK_SIZE"], sort)
             else:
-                inventories = Inventory.find_by_attributes(req_dict)
+                inventories = Inventory.find_rows(req_dict, sort=sort)
         except Exception:
             abort(status.HTTP_400_BAD_REQUEST, "Query parameters not valid")
 
-        results = [inventory.serialize() for inventory in inventories]
-        return results, status.HTTP_200_OK
+        headers['ETag'] = quote_etag(etag)
+        if streaming:
+            return stream_ndjson(inventories, headers)
+
+        # the rows are already serialized in the shape of inventory_model
+        return inventories, status.HTTP_200_OK, headers
 
     # ------------------------------------------------------------------
     # ADD A NEW INVENTORY
@@ -141,7 +265,8 @@ class InventoryCollection(Resource):
         """
         app.logger.info("Request to create an Inventory")
         inventory = Inventory()
-        app.logger.info("Payload = %s", api.payload)
+        if app.config["LOG_PAYLOADS"]:
+            app.logger.info("Payload = %s", api.payload)
         inventory.deserialize(api.payload)
         inventory.create()
 
@@ -153,6 +278,227 @@ class InventoryCollection(Resource):
 
         return inventory.serialize(), status.HTTP_201_CREATED, {'Location': location_url}
 
+######################################################################
+#  PATH: /inventories/summary
+######################################################################
+@api.route('/inventories/summary', strict_slashes=False)
+class SummaryResource(Resource):
+    """ Aggregates of the Inventories computed in the database """
+    @api.doc('summarize_inventories')
+    @api.expect(summary_args, validate=True)
+    @api.response(400, "Query parameters not valid")
+    def get(self):
+        """
+        Summarizes the Inventories
+        This endpoint returns the number of inventories and their total
+        quantity grouped by condition and/or restock_level
+        """
+        app.logger.info("Request for Inventory summary")
+        try:
+            req_dict = summary_args.parse_args()
+            req_dict = {k: v for k, v in req_dict.items() if v is not None}
+            group_by = [attr.strip() for attr in req_dict.pop('group_by').split(',') if attr.strip()]
+            product_id_min = req_dict.pop('product_id_min', None)
+            product_id_max = req_dict.pop('product_id_max', None)
+            groups = Inventory.summarize(group_by, req_dict, product_id_min, product_id_max)
+        except Exception:
+            abort(status.HTTP_400_BAD_REQUEST, "Query parameters not valid")
+
+        total = {
+            "count": sum(group["count"] for group in groups),
+            "quantity": sum(group["quantity"] for group in groups),
+        }
+        return {"groups": groups, "total": total}, status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /inventories/export
+######################################################################
+@api.route('/inventories/export', strict_slashes=False)
+class ExportResource(Resource):
+    """ Full dumps of the Inventories for reconciliation """
+    @api.doc('export_inventories')
+    @api.expect(export_args, validate=True)
+    @api.produces(list(EXPORT_FORMATS.values()) + [GZIP_MEDIA_TYPE])
+    @api.response(200, "The Inventories as an attachment")
+    @api.response(400, "Query parameters not valid")
+    def get(self):
+        """
+        Exports the Inventories
+        This endpoint streams the Inventories matching the filters as CSV
+        or JSON Lines, optionally gzipped, in chunks of STREAM_CHUNK_SIZE
+        rows read from a server-side cursor. X-Change-Cursor is a since
+        for the change feed that continues from the dump.
+        """
+        app.logger.info("Request for an Inventory export")
+        try:
+            req_dict = export_args.parse_args()
+            req_dict = {k: v for k, v in req_dict.items() if v is not None}
+            export_format = req_dict.pop('format')
+            compress = req_dict.pop('gzip')
+            sort = req_dict.pop('sort')
+            # the rows are only read once the response streams, check the filters now
+            Inventory.build_filters(req_dict)
+            # read before the rows, the change feed may repeat but never miss a change
+            cursor = ChangeCounter.current()
+        except Exception:
+            abort(status.HTTP_400_BAD_REQUEST, "Query parameters not valid")
+
+        chunk_size = app.config["STREAM_CHUNK_SIZE"]
+        rows = Inventory.iter_rows(req_dict, chunk_size, sort)
+        filename = f"inventory.{export_format}" + (".gz" if compress else "")
+        return Response(
+            stream_with_context(export_chunks(rows, export_format, chunk_size, compress)),
+            status=status.HTTP_200_OK,
+            mimetype=GZIP_MEDIA_TYPE if compress else EXPORT_FORMATS[export_format],
+            headers={
+                "Content-Disposition": f"attachment; filename={filename}",
+                "X-Change-Cursor": str(cursor),
+            },
+        )
+
+
+######################################################################
+#  PATH: /inventories/changes
+######################################################################
+@api.route('/inventories/changes', strict_slashes=False)
+class ChangesResource(Resource):
+    """ The feed of changed and deleted Inventories for incremental sync """
+    @api.doc('list_inventory_changes')
+    @api.expect(changes_args, validate=True)
+    @api.response(200, "Success")
+    @api.response(400, "Query parameters not valid")
+    def get(self):
+        """
+        Returns the Inventories changed since a cursor
+        Every entry is an Inventory at its latest version, or a tombstone
+        with deleted set for a removed one. X-Next-Cursor is the since of
+        the next call, and the Link header is set while more are waiting.
+        """
+        app.logger.info("Request for Inventory changes")
+        try:
+            req_dict = changes_args.parse_args()
+            max_page_size = app.config["MAX_PAGE_SIZE"]
+            limit = req_dict.get('limit')
+            limit = max_page_size if limit is None else min(limit, max_page_size)
+            if limit < 1:
+                raise ValueError("limit must be positive")
+            changes, cursor, more = Inventory.find_changes(req_dict.get('since'), limit)
+        except Exception:
+            abort(status.HTTP_400_BAD_REQUEST, "Query parameters not valid")
+
+        headers = {'X-Next-Cursor': cursor}
+        if more:
+            next_url = api.url_for(ChangesResource, _external=True, since=cursor, limit=limit)
+            headers['Link'] = f'<{next_url}>; rel="next"'
+        return changes, status.HTTP_200_OK, headers
+
+
+######################################################################
+#  PATH: /events
+######################################################################
+@api.route('/events', strict_slashes=False)
+class EventsResource(Resource):
+    """ Server-Sent Events of restock level and quantity transitions """
+    @api.doc('stream_inventory_events')
+    @api.expect(events_args, validate=True)
+    @api.produces([EVENT_STREAM_MEDIA_TYPE])
+    @api.response(200, "An endless text/event-stream")
+    @api.response(400, "Query parameters not valid")
+    @api.response(503, "The worker already serves SSE_MAX_CLIENTS streams")
+    def get(self):
+        """
+        Streams the Inventory transitions
+        Sends a restock_level event when an Inventory moves to another
+        restock level and a quantity event when its quantity crosses
+        quantity_below. A client that falls SSE_CLIENT_BUFFER events
+        behind is sent an overflow event with a since cursor for the
+        change feed and disconnected.
+        """
+        app.logger.info("Request for an Inventory event stream")
+        try:
+            req_dict = events_args.parse_args()
+            subscription = Subscription.from_args(
+                req_dict, app.config["SSE_CLIENT_BUFFER"], since=ChangeCounter.current())
+        except Exception:
+            abort(status.HTTP_400_BAD_REQUEST, "Query parameters not valid")
+        broker.subscribe(subscription)
+
+        # no stream_with_context: the database session is released
+        # when the response starts, the stream only needs the broker
+        return Response(
+            stream_events(broker, subscription, app.config["SSE_KEEPALIVE"]),
+            mimetype=EVENT_STREAM_MEDIA_TYPE,
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
+
+######################################################################
+#  PATH: /inventories/bulk
+######################################################################
+@api.route('/inventories/bulk', strict_slashes=False)
+class BulkResource(Resource):
+    """ Handles bulk creation of Inventories """
+    @api.doc('bulk_create_inventories')
+    @api.expect(bulk_args, [create_model])
+    @api.response(200, 'Per-item status of the posted Inventories')
+    @api.response(400, 'The posted data was not valid')
+    def post(self):
+        """
+        Creates many Inventories
+        This endpoint accepts a JSON array or an NDJSON body and inserts
+        the valid inventories in batches, reporting a status per item
+        """
+        app.logger.info("Request to bulk create Inventories")
+        batch_size = bulk_args.parse_args().get('batch_size')
+        if batch_size is not None and batch_size < 1:
+            abort(status.HTTP_400_BAD_REQUEST, "batch_size must be at least 1")
+        batch_size = batch_size or app.config["BULK_INSERT_BATCH_SIZE"]
+        items = read_bulk_payload()
+
+        validator = Draft4Validator(create_model.__schema__)
+        results = []
+        pending = []
+        for index, item in enumerate(items):
+            errors = [error.message for error in validator.iter_errors(item)]
+            if errors:
+                results.append({"index": index,
+                                "status": status.HTTP_400_BAD_REQUEST,
+                                "message": "Invalid Inventory: " + "; ".join(errors)})
+            else:
+                results.append(None)
+                pending.append(index)
+
+        for start in range(0, len(pending), batch_size):
+            batch = pending[start:start + batch_size]
+            try:
+                inventory_ids = Inventory.create_batch([items[i] for i in batch])
+            except DataValidationError as error:
+                for index in batch:
+                    results[index] = {"index": index,
+                                      "status": status.HTTP_400_BAD_REQUEST,
+                                      "message": str(error)}
+                continue
+            for index, inventory_id in zip(batch, inventory_ids):
+                if inventory_id is None:
+                    results[index] = {"index": index,
+                                      "status": status.HTTP_409_CONFLICT,
+                                      "message": "Re-creating inventory with "
+                                                 "an existing product_id & condition"}
+                else:
+                    results[index] = {"index": index,
+                                      "status": status.HTTP_201_CREATED,
+                                      "inventory_id": inventory_id}
+
+        summary = {
+            "created": sum(r["status"] == status.HTTP_201_CREATED for r in results),
+            "conflicts": sum(r["status"] == status.HTTP_409_CONFLICT for r in results),
+            "failed": sum(r["status"] == status.HTTP_400_BAD_REQUEST for r in results),
+        }
+        app.logger.info("Bulk create finished: %s", summary)
+        return dict(summary, results=results), status.HTTP_200_OK
+
+
 ######################################################################
 #  PATH: /inventories/clear
 ######################################################################
@@ -160,31 +506,84 @@ class InventoryCollection(Resource):
 class ClearResource(Resource):
     """ Delete all actions for Inventories """
     @api.doc('Delete_inventories')
-    @api.expect(inventory_args, validate=True)
+    @api.expect(clear_args, validate=True)
     @api.response(204, 'Inventories deleted')
+    @api.response(400, 'Query parameters not valid')
     def delete(self):
         """
         Delete all Selected Inventories
         This endpoint will delete all selected Inventories
+        with a set-based DELETE and report the count in X-Deleted-Count
         """
         app.logger.info("Request to delete inventories")
-        inventories = []
-
         try:
-            req_dict = inventory_args.parse_args()
+            req_dict = clear_args.parse_args()
             req_dict = {k: v for k, v in req_dict.items() if v is not None}
-            if len(req_dict) == 0:
-                inventories = Inventory.all()
-            else:
-                inventories = Inventory.find_by_attributes(req_dict)
-        except Exception:
-            pass
+            chunk_size = req_dict.pop('chunk_size', None)
+            if chunk_size is not None and chunk_size < 0:
+                raise DataValidationError("chunk_size must not be negative")
+            Inventory.build_filters(req_dict)
+        except (DataValidationError, KeyError, ValueError):
+            abort(status.HTTP_400_BAD_REQUEST, "Query parameters not valid")
 
-        for inventory in inventories:
-            inventory.delete()
-            app.logger.info('Inventory with id [%s] was deleted', inventory.inventory_id)
+        # errors of the DELETE itself are not hidden, some chunks may
+        # already be committed when a later one fails
+        deleted = Inventory.delete_by_attributes(req_dict, chunk_size)
+        app.logger.info('%s inventories were deleted', deleted)
+        return '', status.HTTP_204_NO_CONTENT, {'X-Deleted-Count': str(deleted)}
+
+######################################################################
+#  PATH: /thresholds/{product_id}
+######################################################################
+@api.route('/thresholds/<int:product_id>')
+@api.param('product_id', 'The product identifier')
+class ThresholdResource(Resource):
+    """
+    ThresholdResource class
+    Manages the restock level thresholds of a product
+    GET /thresholds/{product_id} - Returns the thresholds of the product
+    PUT /thresholds/{product_id} - Sets the thresholds and recomputes the restock levels
+    DELETE /thresholds/{product_id} - Falls back to the global thresholds
+    """
+
+    @api.doc('get_thresholds')
+    @api.response(404, 'Thresholds not found')
+    @api.marshal_with(threshold_model)
+    def get(self, product_id):
+        """Returns the restock level thresholds of a product"""
+        app.logger.info("Request for thresholds of product %s", product_id)
+        threshold = RestockThreshold.find(product_id)
+        if not threshold:
+            abort(status.HTTP_404_NOT_FOUND,
+                  f"Thresholds of product '{product_id}' were not found.")
+        return threshold.serialize(), status.HTTP_200_OK
+
+    @api.doc('set_thresholds')
+    @api.response(400, 'The posted thresholds were not valid')
+    @api.expect(threshold_model)
+    @api.marshal_with(threshold_model)
+    def put(self, product_id):
+        """
+        Set the restock level thresholds of a product
+        The restock_level of the product's inventories is recomputed
+        """
+        app.logger.info("Request to set thresholds of product %s", product_id)
+        check_content_type("application/json")
+        threshold = RestockThreshold.save(product_id, api.payload)
+        return threshold.serialize(), status.HTTP_200_OK
+
+    @api.doc('delete_thresholds')
+    @api.response(204, 'Thresholds deleted')
+    def delete(self, product_id):
+        """
+        Delete the restock level thresholds of a product
+        The product's inventories fall back to the global thresholds
+        """
+        app.logger.info("Request to delete thresholds of product %s", product_id)
+        RestockThreshold.remove(product_id)
         return '', status.HTTP_204_NO_CONTENT
 
+
 ######################################################################
 # RETRIEVE AN INVENTORY   (#story 4)
 ######################################################################
@@ -196,14 +595,23 @@ def get_inventory(inventory_id):
     This endpoint will return an Inventory based on it's id
     """
     app.logger.info("Request for Inventory with id: %s", inventory_id)
-    inventory = Inventory.find(inventory_id)
+    # the cache of this worker may miss the writes of the others, so a
+    # 304 and a read of the client's own write come from the database
+    use_cache = not request.if_none_match and CONSISTENCY_TOKEN_HEADER not in request.headers
+    inventory = Inventory.find_row(inventory_id, use_cache=use_cache)
     if not inventory:
         abort(
             status.HTTP_404_NOT_FOUND,
             f"Inventory with id '{inventory_id}' could not be found.",
         )
 
-    return make_response(jsonify(inventory.serialize()), status.HTTP_200_OK)
+    etag = inventory_etag(inventory)
+    if request.if_none_match.contains(etag):
+        return not_modified(etag)
+
+    response = make_response(jsonify(inventory), status.HTTP_200_OK)
+    response.set_etag(etag)
+    return response
 
 
 # # ######################################################################
@@ -225,11 +633,15 @@ def update_inventory(inventory_id):
             status.HTTP_404_NOT_FOUND,
             f"Inventory with id '{inventory_id}' was not found.",
         )
+    check_if_match(inventory.serialize())
     # inventory.deserialize(request.get_json())
     # inventory.id = inventory_id
     # inventory.update()
     inventory.update(request.get_json())
-    return make_response(jsonify(inventory.serialize()), status.HTTP_200_OK)
+    data = inventory.serialize()
+    response = make_response(jsonify(data), status.HTTP_200_OK)
+    response.set_etag(inventory_etag(data))
+    return response
 
 ######################################################################
 # UPDATE QUANTITY UNDER PRODUCT_ID & CONDITION (Action)
@@ -239,7 +651,9 @@ def update_inventory_by_product_id_condition():
     """
     Update an Inventory by product_id & condition
 
-    This endpoint will update an Inventory based on the body that is posted
+    This endpoint will update an Inventory based on the body that is posted.
+    When the body holds a delta instead of a quantity the stock is changed
+    atomically by that amount and the restock_level is recomputed.
     """
     check_content_type("application/json")
 
@@ -252,6 +666,17 @@ def update_inventory_by_product_id_condition():
         "product_id: %s & condition: %s",
         req_product_id, req_condition)
 
+    if "delta" in request_dict:
+        inventory = Inventory.change_quantity(
+            req_product_id, req_condition, request_dict["delta"])
+        if not inventory:
+            abort(
+                status.HTTP_404_NOT_FOUND,
+                f"Inventory with product_id '{req_product_id}' & "
+                f"condition '{req_condition}' was not found.",
+            )
+        return make_response(jsonify(inventory), status.HTTP_200_OK)
+
     inventories = Inventory.find_by_attributes(
         {"product_id": req_product_id,
          "condition": req_condition}
@@ -280,9 +705,167 @@ def health():
     return make_response(jsonify(status=200, message="OK"), status.HTTP_200_OK)
 
 
+############################################################
+# Cache and Pool Statistics Endpoint
+############################################################
+@app.route("/stats")
+def stats():
+    """Counters of this worker's lookup cache, connection pool and event streams"""
+    pool = db.engine.pool
+    pool_stats = pool.stats() if hasattr(pool, "stats") else {"status": pool.status()}
+    return make_response(
+        jsonify(cache=Inventory.cache.stats(), pool=pool_stats, events=broker.stats()),
+        status.HTTP_200_OK)
+
+
+############################################################
+# Metrics Endpoint
+############################################################
+@app.route("/metrics")
+def metrics():
+    """Prometheus metrics of all workers"""
+    return Response(generate_metrics(), mimetype=CONTENT_TYPE_LATEST)
+
+
+############################################################
+# Read Replica Routing
+############################################################
+@app.before_request
+def route_reads():
+    """Sends the reads of GET and HEAD requests to a read replica"""
+    if request.method not in ("GET", "HEAD"):
+        return
+    token = request.headers.get(CONSISTENCY_TOKEN_HEADER)
+    if token is not None:
+        try:
+            token = int(token)
+        except ValueError:
+            abort(status.HTTP_400_BAD_REQUEST,
+                  f"{CONSISTENCY_TOKEN_HEADER} must be an integer")
+    use_read_replica(token)
+
+
+@app.after_request
+def add_consistency_token(response):
+    """Hands the client the version of its write"""
+    seq = g.pop("change_seq", None)
+    if seq is not None and response.status_code < 400:
+        response.headers[CONSISTENCY_TOKEN_HEADER] = str(seq)
+    return response
+
+
+@app.teardown_request
+def reset_read_routing(_error=None):
+    """Forgets the replica of the finished request"""
+    g.pop("read_replica", None)
+    g.pop("change_seq", None)
+
+
 # ######################################################################
 # #  U T I L I T Y   F U N C T I O N S
 # ######################################################################
+def list_page(req_dict, limit, after, sort=None):
+    """Returns a keyset page of Inventories and the headers linking the next one"""
+    max_page_size = app.config["MAX_PAGE_SIZE"]
+    limit = max_page_size if limit is None else min(limit, max_page_size)
+    if limit < 1:
+        raise ValueError("limit must be positive")
+
+    # fetch one extra row to tell whether there is a next page
+    inventories = Inventory.find_rows(req_dict, limit + 1, after, sort)
+    if len(inventories) <= limit:
+        return inventories, {}
+
+    inventories = inventories[:limit]
+    cursor = Inventory.cursor_of(inventories[-1], sort)
+    args = request.args.to_dict()
+    args.update(limit=limit, after=cursor)
+    next_url = api.url_for(InventoryCollection, _external=True, **args)
+    return inventories, {
+        'Link': f'<{next_url}>; rel="next"',
+        'X-Next-Cursor': str(cursor),
+    }
+
+
+def list_etag(query, streaming=False):
+    """Returns the ETag of a list query, every committed write changes it"""
+    scope = json.dumps(query, sort_keys=True, default=str) + ("-ndjson" if streaming else "")
+    return "list-" + ChangeCounter.snapshot_tag(scope)
+
+
+def inventory_etag(inventory):
+    """Returns the strong ETag of a serialized Inventory"""
+    return f"{inventory['inventory_id']}-{inventory['version']}"
+
+
+def not_modified(etag):
+    """Returns an empty 304 Not Modified response for the ETag"""
+    response = make_response("", status.HTTP_304_NOT_MODIFIED)
+    response.set_etag(etag)
+    return response
+
+
+def check_if_match(inventory):
+    """Checks the If-Match header against the current Inventory"""
+    if request.if_match and not request.if_match.contains(inventory_etag(inventory)):
+        app.logger.error("If-Match does not match inventory %s", inventory["inventory_id"])
+        abort(
+            status.HTTP_412_PRECONDITION_FAILED,
+            f"Inventory with id '{inventory['inventory_id']}' has been modified.",
+        )
+
+
+def wants_ndjson():
+    """Checks whether the client prefers NDJSON over a JSON list"""
+    best = request.accept_mimetypes.best_match(["application/json", NDJSON_MEDIA_TYPE])
+    return best == NDJSON_MEDIA_TYPE
+
+
+def stream_ndjson(inventories, headers=None):
+    """Streams serialized Inventories as NDJSON, one chunk per STREAM_CHUNK_SIZE rows"""
+    chunk_size = app.config["STREAM_CHUNK_SIZE"]
+
+    def generate():
+        lines = []
+        for inventory in inventories:
+            lines.append(json.dumps(inventory) + "\n")
+            if len(lines) >= chunk_size:
+                yield "".join(lines)
+                lines = []
+        if lines:
+            yield "".join(lines)
+
+    return Response(
+        stream_with_context(generate()),
+        status=status.HTTP_200_OK,
+        mimetype=NDJSON_MEDIA_TYPE,
+        headers=headers,
+    )
+
+
+def read_bulk_payload():
+    """Reads a JSON array or an NDJSON body into a list of items"""
+    if request.mimetype == "application/x-ndjson":
+        items = []
+        for line in request.get_data(as_text=True).splitlines():
+            if not line.strip():
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError:
+                items.append(None)  # reported as an invalid item
+        return items
+
+    check_content_type("application/json")
+    items = request.get_json()
+    if not isinstance(items, list):
+        abort(
+            status.HTTP_400_BAD_REQUEST,
+            "Request body must be a JSON array of Inventories",
+        )
+    return items
+
+
 def check_content_type(media_type):
     """Checks that the media type is correct"""
     content_type = request.headers.get("Content-Type")
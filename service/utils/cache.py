@@ -0,0 +1,124 @@
+"""
+Cache
+
+This module contains the read-through caches that sit in front of the
+single inventory lookups. Every cache shares the same small interface
+(get, set, delete, clear, stats) so another backend can be plugged in
+through the CACHE_TYPE setting.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class NullCache:
+    """A cache that never stores anything, used when caching is disabled"""
+
+    generation = 0
+
+    def get(self, key):
+        """Always misses"""
+        return None
+
+    def set(self, key, value, generation=None):
+        """Discards the value"""
+
+    def delete(self, key):
+        """Nothing to invalidate"""
+
+    def clear(self):
+        """Nothing to invalidate"""
+
+    def stats(self) -> dict:
+        """Returns the counters of the cache"""
+        return {"type": "null"}
+
+
+class LRUCache:
+    """
+    An in-process cache with LRU eviction and a time to live
+
+    The cache is local to each worker process: an invalidation only
+    reaches the worker that made the write, so CACHE_TTL bounds how
+    long another worker may serve a stale entry.
+    """
+
+    def __init__(self, max_size=10000, ttl=30.0, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        # bumped by every invalidation, see set()
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        """Returns the cached value for key, or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires = entry
+            if expires <= self.clock():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, generation=None):
+        """Stores value under key
+
+        When generation is given and an invalidation happened since it
+        was read, the value may already be stale and is not stored.
+        """
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._entries[key] = (value, self.clock() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        """Invalidates the entry for key"""
+        with self._lock:
+            self.generation += 1
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Invalidates every entry"""
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        """Returns the counters of the cache"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "type": "lru",
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+            }
+
+
+def make_cache(config):
+    """Creates the cache selected by the CACHE_TYPE setting"""
+    if config.get("CACHE_TYPE", "null") == "lru":
+        return LRUCache(config.get("CACHE_MAX_SIZE", 10000), config.get("CACHE_TTL", 30.0))
+    return NullCache()
@@ -18,7 +18,13 @@
 Module: error_handlers
 """
 from flask import jsonify
-from service.models import DataValidationError, DuplicateKeyValueError
+from service.models import (
+    DataValidationError,
+    DuplicateKeyValueError,
+    InsufficientQuantityError,
+    StaleVersionError,
+)
+from service.events import TooManySubscribersError
 from service import app
 from . import status
 
@@ -38,6 +44,24 @@ def duplicate_key_value_error(error):
     return data_conflict(error)
 
 
+@app.errorhandler(InsufficientQuantityError)
+def insufficient_quantity_error(error):
+    """Handles quantity changes that would push the stock below zero"""
+    return data_conflict(error)
+
+
+@app.errorhandler(StaleVersionError)
+def stale_version_error(error):
+    """Handles writes based on an outdated version of a record"""
+    return data_conflict(error)
+
+
+@app.errorhandler(TooManySubscribersError)
+def too_many_subscribers(error):
+    """Handles event streams beyond the limit of the worker"""
+    return service_unavailable(error)
+
+
 @app.errorhandler(status.HTTP_400_BAD_REQUEST)
 def bad_request(error):
     """Handles bad requests with 400_BAD_REQUEST"""
@@ -75,3 +99,33 @@ def data_conflict(error):
         ),
         status.HTTP_409_CONFLICT,
     )
+
+
+@app.errorhandler(status.HTTP_412_PRECONDITION_FAILED)
+def precondition_failed(error):
+    """Handles stale conditional requests with 412_PRECONDITION_FAILED"""
+    message = str(error)
+    app.logger.warning(message)
+    return (
+        jsonify(
+            status=status.HTTP_412_PRECONDITION_FAILED,
+            error="Precondition Failed",
+            message=message,
+        ),
+        status.HTTP_412_PRECONDITION_FAILED,
+    )
+
+
+@app.errorhandler(status.HTTP_503_SERVICE_UNAVAILABLE)
+def service_unavailable(error):
+    """Handles requests the service cannot take now with 503_SERVICE_UNAVAILABLE"""
+    message = str(error)
+    app.logger.warning(message)
+    return (
+        jsonify(
+            status=status.HTTP_503_SERVICE_UNAVAILABLE,
+            error="Service Unavailable",
+            message=message,
+        ),
+        status.HTTP_503_SERVICE_UNAVAILABLE,
+    )
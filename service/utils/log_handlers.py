@@ -18,21 +18,134 @@
 Log Handlers
 
 This module contains utility functions to set up logging
-consistently
+consistently. With LOG_ASYNC the records are handed to a queue and
+written by a background thread, so a slow stdout does not slow down
+the requests. LOG_FORMAT=json writes one JSON object per line and
+LOG_SAMPLE_RATES keeps only a share of the INFO records of busy loggers.
 """
+import atexit
+import json
 import logging
+import os
+import queue
+import random
+from logging.handlers import QueueHandler, QueueListener
 
 
 def init_logging(app, logger_name: str):
     """Set up logging for production"""
     app.logger.propagate = False
     gunicorn_logger = logging.getLogger(logger_name)
-    app.logger.handlers = gunicorn_logger.handlers
+    handlers = gunicorn_logger.handlers
     app.logger.setLevel(gunicorn_logger.level)
     # Make all log formats consistent
-    formatter = logging.Formatter(
-        "[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s", "%Y-%m-%d %H:%M:%S %z"
-    )
-    for handler in app.logger.handlers:
+    if app.config.get("LOG_FORMAT") == "json":
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter(
+            "[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s", "%Y-%m-%d %H:%M:%S %z"
+        )
+    for handler in handlers:
         handler.setFormatter(formatter)
+
+    if app.config.get("LOG_ASYNC"):
+        log_queue = queue.Queue(app.config.get("LOG_QUEUE_SIZE", 10000))
+        handlers = [DroppingQueueHandler(log_queue, handlers)]
+    app.logger.handlers = handlers
+
+    sample_rates = app.config.get("LOG_SAMPLE_RATES")
+    if sample_rates:
+        for handler in app.logger.handlers:
+            handler.addFilter(SamplingFilter(sample_rates))
     app.logger.info("Logging handler established")
+
+
+def parse_sample_rates(value: str) -> dict:
+    """Parses "logger=rate,..." into a dictionary of sampling rates"""
+    rates = {}
+    for item in value.split(","):
+        if item.strip():
+            name, rate = item.split("=")
+            rates[name.strip()] = float(rate)
+    return rates
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as a single line JSON object"""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S%z"),
+            "level": record.levelname,
+            "logger": record.name,
+            "module": record.module,
+            "message": record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps a share of the INFO and DEBUG records of the named loggers
+
+    The rate of the most specific matching logger name applies, so
+    {"service": 1.0, "service.models": 0.1} keeps one in ten model
+    records. Warnings and errors are always kept.
+    """
+
+    def __init__(self, rates: dict, rand=random.random):
+        super().__init__()
+        self.rates = rates
+        self.rand = rand
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        name = record.name
+        while name:
+            if name in self.rates:
+                return self.rand() < self.rates[name]
+            name = name.rpartition(".")[0]
+        return True
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    A QueueHandler that drops records instead of blocking when the queue is full
+
+    The thread that writes the queued records to the targets is started
+    by the first record of each process. A gunicorn --preload master
+    sets up logging before it forks, and threads do not survive a fork,
+    so every worker starts a listener of its own.
+    """
+
+    def __init__(self, log_queue, targets=()):
+        super().__init__(log_queue)
+        self.targets = targets
+        self.listener = None
+        self.dropped = 0
+        self._pid = None
+
+    def _start_listener(self):
+        """Starts the listener of this process, called with the handler lock held"""
+        if self._pid is not None:
+            # the listener of the parent is gone and its queue may have
+            # been locked by one of the parent's threads
+            atexit.unregister(self.listener.stop)
+            self.queue = queue.Queue(self.queue.maxsize)
+        self.listener = QueueListener(self.queue, *self.targets, respect_handler_level=True)
+        self.listener.start()
+        atexit.register(self.listener.stop)
+        self._pid = os.getpid()
+
+    def enqueue(self, record):
+        if self.targets and self._pid != os.getpid():
+            self._start_listener()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
@@ -0,0 +1,174 @@
+"""
+Metrics
+
+This module collects the Prometheus metrics of the service: request
+counts, latencies and status codes per route, database queries per
+request, and the counters of the connection pool and lookup cache.
+The statement count and database time of each request are also sent
+in its Server-Timing header, and statements slower than
+SLOW_QUERY_THRESHOLD are logged.
+
+Under gunicorn every worker keeps its own metrics. When the
+PROMETHEUS_MULTIPROC_DIR environment variable names a directory the
+workers write their values there and /metrics adds them up, see
+gunicorn.conf.py.
+"""
+import logging
+import os
+import time
+from flask import g, request, has_request_context
+from prometheus_client import (
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from service import app
+from service.models import db, Inventory
+
+logger = logging.getLogger(__name__)
+
+# Longest parameter list written to the slow query log
+MAX_LOGGED_PARAMETERS = 500
+
+REQUESTS = Counter(
+    "inventory_http_requests_total",
+    "HTTP requests handled",
+    ["method", "route", "status"],
+)
+REQUEST_LATENCY = Histogram(
+    "inventory_http_request_duration_seconds",
+    "Time to build the HTTP response",
+    ["method", "route"],
+    buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10),
+)
+REQUEST_DB_TIME = Histogram(
+    "inventory_http_request_db_seconds",
+    "Time spent executing database statements per HTTP request",
+    ["method", "route"],
+    buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10),
+)
+REQUEST_QUERIES = Histogram(
+    "inventory_http_request_db_queries",
+    "Database statements executed per HTTP request",
+    ["method", "route"],
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100),
+)
+POOL_CHECKED_OUT = Gauge(
+    "inventory_db_pool_checked_out",
+    "Database connections in use",
+    multiprocess_mode="livesum",
+)
+POOL_SATURATED = Gauge(
+    "inventory_db_pool_saturated_checkouts",
+    "Checkouts that found every connection of the pool in use",
+    multiprocess_mode="livesum",
+)
+POOL_WAIT = Gauge(
+    "inventory_db_pool_wait_seconds",
+    "Total time spent waiting for a database connection",
+    multiprocess_mode="livesum",
+)
+CACHE_HITS = Gauge(
+    "inventory_cache_hits",
+    "Lookups answered by the cache",
+    multiprocess_mode="livesum",
+)
+CACHE_MISSES = Gauge(
+    "inventory_cache_misses",
+    "Lookups that missed the cache",
+    multiprocess_mode="livesum",
+)
+
+
+######################################################################
+# Request Hooks
+######################################################################
+@app.before_request
+def start_request_timer():
+    """Remembers when the request started"""
+    g.request_started = time.perf_counter()
+    g.db_queries = 0
+    g.db_time = 0.0
+
+
+@app.after_request
+def record_request(response):
+    """Records the route, status, latency and database cost of the request
+
+    The latency ends when the response is returned to the server, a
+    streamed body is not included.
+    """
+    route = request_route()
+    REQUESTS.labels(request.method, route, response.status_code).inc()
+    started = g.pop("request_started", None)
+    queries = g.pop("db_queries", 0)
+    db_time = g.pop("db_time", 0.0)
+    timings = [f'db;dur={db_time * 1000:.2f};desc="{queries} statements"']
+    if started is not None:
+        elapsed = time.perf_counter() - started
+        REQUEST_LATENCY.labels(request.method, route).observe(elapsed)
+        timings.append(f"total;dur={elapsed * 1000:.2f}")
+    REQUEST_QUERIES.labels(request.method, route).observe(queries)
+    REQUEST_DB_TIME.labels(request.method, route).observe(db_time)
+    response.headers.add("Server-Timing", ", ".join(timings))
+    record_worker_stats()
+    return response
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def start_query_timer(_conn, _cursor, _statement, _parameters, context, _executemany):
+    """Remembers when the statement was sent"""
+    context.query_started = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def record_query(_conn, _cursor, statement, parameters, context, _executemany):
+    """Adds the statement to the cost of the request and logs it when it was slow"""
+    elapsed = time.perf_counter() - context.query_started
+    in_request = has_request_context() and "db_queries" in g
+    if in_request:
+        g.db_queries += 1
+        g.db_time += elapsed
+    if elapsed >= app.config["SLOW_QUERY_THRESHOLD"]:
+        logger.warning(
+            "Slow query took %.3fs on %s: %s parameters: %.*s",
+            elapsed, request_route() if in_request else "-", statement,
+            MAX_LOGGED_PARAMETERS, repr(parameters),
+        )
+
+
+######################################################################
+# Collection
+######################################################################
+def request_route() -> str:
+    """Returns the URL rule the request matched, which keeps the labels few"""
+    return request.url_rule.rule if request.url_rule else "unmatched"
+
+
+def record_worker_stats():
+    """Copies the counters of this worker's pool and cache into the gauges"""
+    pool = db.engine.pool
+    if hasattr(pool, "stats"):
+        pool_stats = pool.stats()
+        POOL_CHECKED_OUT.set(pool_stats["checked_out"])
+        POOL_SATURATED.set(pool_stats["saturated_checkouts"])
+        POOL_WAIT.set(pool_stats["wait_total"])
+    cache_stats = Inventory.cache.stats()
+    CACHE_HITS.set(cache_stats.get("hits", 0))
+    CACHE_MISSES.set(cache_stats.get("misses", 0))
+
+
+def generate_metrics() -> bytes:
+    """Returns the metrics of every worker in the text exposition format"""
+    multiproc_dir = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+    if not multiproc_dir:
+        return generate_latest(REGISTRY)
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry, path=multiproc_dir)
+    return generate_latest(registry)
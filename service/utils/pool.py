@@ -0,0 +1,71 @@
+"""
+Connection Pool
+
+This module contains the QueuePool used by the SQLAlchemy engine. It
+records how long each checkout waited for a connection and how often
+the pool ran out of them, and logs the checkouts that waited longer
+than POOL_SLOW_CHECKOUT.
+"""
+import logging
+import threading
+import time
+from sqlalchemy.pool import QueuePool
+
+logger = logging.getLogger(__name__)
+
+
+class InstrumentedQueuePool(QueuePool):
+    """
+    A QueuePool that keeps checkout wait and saturation counters
+
+    The counters are local to the worker process, like the pool itself.
+    """
+
+    def __init__(self, creator, slow_checkout=0.1, **kw):
+        super().__init__(creator, **kw)
+        self.slow_checkout = slow_checkout
+        self._stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.saturated_checkouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def connect(self):
+        """Checks out a connection and records how long that took"""
+        # a max_overflow of -1 means the pool never runs out
+        saturated = (self._max_overflow >= 0
+                     and self.checkedout() >= self.size() + self._max_overflow)
+        started = time.monotonic()
+        try:
+            return super().connect()
+        finally:
+            # also counted when the checkout timed out
+            waited = time.monotonic() - started
+            with self._stats_lock:
+                self.checkouts += 1
+                self.saturated_checkouts += saturated
+                self.wait_total += waited
+                self.wait_max = max(self.wait_max, waited)
+            if waited >= self.slow_checkout:
+                logger.warning(
+                    "Waited %.3fs for a database connection: %s", waited, self.status())
+
+    def recreate(self):
+        """Returns a new pool with the same settings, e.g. after a failover"""
+        pool = super().recreate()
+        pool.slow_checkout = self.slow_checkout
+        return pool
+
+    def stats(self) -> dict:
+        """Returns the counters of the pool"""
+        with self._stats_lock:
+            return {
+                "size": self.size(),
+                "max_overflow": self._max_overflow,
+                "checked_out": self.checkedout(),
+                "overflow": max(self.overflow(), 0),
+                "checkouts": self.checkouts,
+                "saturated_checkouts": self.saturated_checkouts,
+                "wait_total": round(self.wait_total, 6),
+                "wait_max": round(self.wait_max, 6),
+            }
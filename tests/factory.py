@@ -18,7 +18,8 @@ Test Factory to make fake objects for testing
 # import random
 import factory
 from factory.fuzzy import FuzzyChoice, FuzzyInteger
-from service.models import Inventory,  Condition, RestockLevel
+from service.dataset import CONDITIONS, RESTOCK_LEVELS, QUANTITY_RANGE
+from service.models import Inventory,  Condition, RestockLevel  # noqa: F401
 # from service.models import Product
 
 
@@ -31,19 +32,6 @@ class InventoryFactory(factory.Factory):
 
     product_id = factory.Sequence(lambda n: n)
     inventory_id = None
-    condition = FuzzyChoice(
-        choices=[
-            Condition.NEW,
-            Condition.OPEN_BOX,
-            Condition.USED
-        ]
-    )
-    restock_level = FuzzyChoice(
-        choices=[
-            RestockLevel.EMPTY,
-            RestockLevel.LOW,
-            RestockLevel.MODERATE,
-            RestockLevel.PLENTY,
-        ]
-    )
-    quantity = FuzzyInteger(10, 5000)
+    condition = FuzzyChoice(choices=CONDITIONS)
+    restock_level = FuzzyChoice(choices=RESTOCK_LEVELS)
+    quantity = FuzzyInteger(*QUANTITY_RANGE)
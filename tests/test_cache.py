@@ -0,0 +1,85 @@
+"""
+Test cases for the lookup caches
+
+"""
+from unittest import TestCase
+from service.utils.cache import LRUCache, NullCache, make_cache
+
+
+class FakeClock:
+    """A clock that only moves when told to"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+######################################################################
+#  C A C H E   T E S T   C A S E S
+######################################################################
+class TestLRUCache(TestCase):
+    """Test Cases for the LRU cache"""
+
+    def setUp(self):
+        """This runs before each test"""
+        self.clock = FakeClock()
+        self.cache = LRUCache(max_size=2, ttl=10, clock=self.clock)
+
+    def test_get_and_set(self):
+        """It should return cached values and count hits and misses"""
+        self.assertIsNone(self.cache.get(1))
+        self.cache.set(1, {"inventory_id": 1})
+        self.assertEqual(self.cache.get(1), {"inventory_id": 1})
+        stats = self.cache.stats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["size"], 1)
+        self.assertEqual(stats["hit_ratio"], 0.5)
+
+    def test_lru_eviction(self):
+        """It should evict the least recently used entry"""
+        self.cache.set(1, "a")
+        self.cache.set(2, "b")
+        self.cache.get(1)
+        self.cache.set(3, "c")
+        self.assertIsNone(self.cache.get(2))
+        self.assertEqual(self.cache.get(1), "a")
+        self.assertEqual(self.cache.get(3), "c")
+        self.assertEqual(self.cache.stats()["evictions"], 1)
+
+    def test_ttl(self):
+        """It should expire entries after the time to live"""
+        self.cache.set(1, "a")
+        self.clock.now = 9
+        self.assertEqual(self.cache.get(1), "a")
+        self.clock.now = 10
+        self.assertIsNone(self.cache.get(1))
+        self.assertEqual(self.cache.stats()["expirations"], 1)
+
+    def test_invalidation(self):
+        """It should invalidate entries and drop fills that raced a write"""
+        self.cache.set(1, "a")
+        generation = self.cache.generation
+        self.cache.delete(1)
+        self.assertIsNone(self.cache.get(1))
+        # a value read before the invalidation must not be stored
+        self.cache.set(1, "stale", generation)
+        self.assertIsNone(self.cache.get(1))
+        self.cache.set(1, "fresh", self.cache.generation)
+        self.assertEqual(self.cache.get(1), "fresh")
+        self.cache.clear()
+        self.assertIsNone(self.cache.get(1))
+
+    def test_make_cache(self):
+        """It should create the cache named by CACHE_TYPE"""
+        cache = make_cache({"CACHE_TYPE": "lru", "CACHE_MAX_SIZE": 5, "CACHE_TTL": 1})
+        self.assertIsInstance(cache, LRUCache)
+        self.assertEqual(cache.max_size, 5)
+        cache = make_cache({"CACHE_TYPE": "null"})
+        self.assertIsInstance(cache, NullCache)
+        cache.set(1, "a")
+        self.assertIsNone(cache.get(1))
+        self.assertEqual(cache.stats(), {"type": "null"})
+        self.assertIsInstance(make_cache({}), NullCache)
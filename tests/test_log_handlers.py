@@ -0,0 +1,108 @@
+"""
+Test cases for the logging setup
+
+"""
+import io
+import json
+import logging
+import os
+import queue
+import tempfile
+from unittest import TestCase
+from flask import Flask
+from service import app, events, models
+from service.utils import metrics, pool
+from service.utils.log_handlers import (
+    DroppingQueueHandler,
+    JsonFormatter,
+    SamplingFilter,
+    init_logging,
+    parse_sample_rates,
+)
+
+SERVER_LOGGER = "tests.server"
+
+
+def make_record(name="service", level=logging.INFO, msg="hello %s", args=("world",)):
+    """Returns a log record like the ones the service writes"""
+    return logging.LogRecord(name, level, __file__, 1, msg, args, None)
+
+
+######################################################################
+#  L O G G I N G   T E S T   C A S E S
+######################################################################
+class TestLogHandlers(TestCase):
+    """Test Cases for the log handlers"""
+
+    def setUp(self):
+        """This runs before each test"""
+        self.stream = io.StringIO()
+        server_logger = logging.getLogger(SERVER_LOGGER)
+        server_logger.handlers = [logging.StreamHandler(self.stream)]
+        server_logger.setLevel(logging.INFO)
+        self.app = Flask("log_test")
+
+    def test_json_formatter(self):
+        """It should format a record as one JSON object"""
+        entry = json.loads(JsonFormatter().format(make_record()))
+        self.assertEqual(entry["message"], "hello world")
+        self.assertEqual(entry["level"], "INFO")
+        self.assertEqual(entry["logger"], "service")
+
+    def test_sampling_filter(self):
+        """It should sample INFO records of the most specific logger and keep warnings"""
+        rates = parse_sample_rates("service=1, service.models=0.25")
+        self.assertEqual(rates, {"service": 1.0, "service.models": 0.25})
+        sampler = SamplingFilter(rates, rand=lambda: 0.5)
+        self.assertTrue(sampler.filter(make_record("service")))
+        self.assertFalse(sampler.filter(make_record("service.models")))
+        self.assertTrue(sampler.filter(make_record("service.models", logging.WARNING)))
+        self.assertTrue(sampler.filter(make_record("gunicorn.error")))
+
+    def test_service_loggers(self):
+        """It should hand the records of the service modules to the app logger"""
+        with self.assertLogs(app.logger, logging.WARNING) as logs:
+            for module in (models, events, metrics, pool):
+                module.logger.warning("from %s", module.__name__)
+        self.assertEqual(len(logs.records), 4)
+
+    def test_dropping_queue_handler(self):
+        """It should drop records instead of blocking on a full queue"""
+        handler = DroppingQueueHandler(queue.Queue(1))
+        handler.handle(make_record())
+        handler.handle(make_record())
+        self.assertEqual(handler.dropped, 1)
+
+    def test_async_json_logging(self):
+        """It should write JSON lines from a background thread"""
+        self.app.config.update(LOG_ASYNC=True, LOG_FORMAT="json",
+                               LOG_SAMPLE_RATES={self.app.logger.name: 0})
+        init_logging(self.app, SERVER_LOGGER)
+        self.assertIsInstance(self.app.logger.handlers[0], DroppingQueueHandler)
+        self.app.logger.info("sampled away")
+        self.app.logger.warning("stock of %s is low", 42)
+
+        # wait until the listener wrote the queued records
+        self.app.logger.handlers[0].queue.join()
+        lines = [json.loads(line) for line in self.stream.getvalue().splitlines()]
+        self.assertEqual([line["message"] for line in lines], ["stock of 42 is low"])
+
+    def test_async_logging_after_fork(self):
+        """It should write the records of a worker forked after the setup"""
+        with tempfile.NamedTemporaryFile("r") as log_file:
+            logging.getLogger(SERVER_LOGGER).handlers = [logging.FileHandler(log_file.name)]
+            self.app.config.update(LOG_ASYNC=True)
+            init_logging(self.app, SERVER_LOGGER)
+            handler = self.app.logger.handlers[0]
+            self.app.logger.warning("from the master")
+            handler.queue.join()
+
+            pid = os.fork()
+            if pid == 0:  # pragma: no cover
+                self.app.logger.warning("from the worker")
+                handler.listener.stop()
+                os._exit(0)
+            os.waitpid(pid, 0)
+            messages = log_file.read()
+        self.assertIn("from the master", messages)
+        self.assertIn("from the worker", messages)
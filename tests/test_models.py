@@ -4,6 +4,8 @@ Test cases for Inventory Model
 """
 import os
 import logging
+import threading
+import time
 # from typing import Type
 import unittest
 from service import app
@@ -11,7 +13,14 @@ from service.models import (
     Inventory,
     DataValidationError,
     DuplicateKeyValueError,
+    InsufficientQuantityError,
+    StaleVersionError,
+    ChangeCounter,
+    InventorySummary,
+    InventoryTombstone,
+    RestockThreshold,
     db,
+    dispose_engines,
     Condition,
     RestockLevel,
 
@@ -51,12 +60,50 @@ class TestInventory(unittest.TestCase):
     def setUp(self):
         """This runs before each test"""
         db.session.query(Inventory).delete()  # clean up the last tests
+        db.session.query(InventorySummary).delete()
+        db.session.query(RestockThreshold).delete()
+        db.session.query(InventoryTombstone).delete()
         db.session.commit()
 
     def tearDown(self):
         """This runs after each test"""
         db.session.remove()
 
+    def _race(self, *calls):
+        """Runs the calls in threads queued in order behind a lock on every inventory row"""
+        errors = []
+
+        def run(call):
+            with app.app_context():
+                try:
+                    call()
+                except Exception as error:  # pylint: disable=broad-except
+                    errors.append(error)
+                finally:
+                    db.session.remove()
+
+        threads = []
+        with db.engine.connect() as blocker:
+            transaction = blocker.begin()
+            blocker.execute(db.text("SELECT 1 FROM inventory FOR UPDATE"))
+            for call in calls:
+                threads.append(threading.Thread(target=run, args=(call,)))
+                threads[-1].start()
+                # the next call starts once this one waits for the lock
+                for _ in range(100):
+                    waiting = blocker.execute(db.text(
+                        "SELECT count(DISTINCT pid) FROM pg_locks WHERE NOT granted"
+                    )).scalar_one()
+                    if waiting == len(threads):
+                        break
+                    time.sleep(0.05)
+            transaction.commit()
+        for thread in threads:
+            thread.join(10)
+        self.assertEqual(errors, [])
+        # the rows of this session were loaded before the threads wrote
+        db.session.expire_all()
+
     ######################################################################
     #  T E S T   C A S E S
     ######################################################################
@@ -283,3 +330,444 @@ class TestInventory(unittest.TestCase):
             quantity=fake_inventory.quantity
         )
         self.assertRaises(DuplicateKeyValueError, inventory_2.create)
+
+    def test_delete_by_attributes(self):
+        """It should Delete all inventories matching the attributes in bulk"""
+        for _ in range(6):
+            InventoryFactory(condition=Condition.NEW).create()
+        for _ in range(4):
+            InventoryFactory(condition=Condition.USED).create()
+        inventory_ids = {row["inventory_id"] for row in Inventory.find_rows({})}
+
+        deleted = Inventory.delete_by_attributes({"condition": "USED"})
+        self.assertEqual(deleted, 4)
+        self.assertEqual(len(Inventory.all()), 6)
+
+        # chunked deletes remove everything across several transactions
+        deleted = Inventory.delete_by_attributes({}, chunk_size=4)
+        self.assertEqual(deleted, 6)
+        self.assertEqual(Inventory.all(), [])
+        # every deleted row got its tombstone and nothing else did
+        tombstones = db.session.query(InventoryTombstone.inventory_id).all()
+        self.assertEqual({row.inventory_id for row in tombstones}, inventory_ids)
+
+        self.assertEqual(Inventory.delete_by_attributes({}), 0)
+        self.assertRaises(
+            DataValidationError,
+            Inventory.delete_by_attributes, {}, -1
+        )
+
+    def test_create_batch(self):
+        """It should Create a batch of inventories skipping duplicates"""
+        existing = InventoryFactory()
+        existing.create()
+        records = [InventoryFactory().serialize() for _ in range(3)]
+        duplicate = existing.serialize()
+        records.append(duplicate)
+        records.append(dict(records[0]))
+
+        inventory_ids = Inventory.create_batch(records)
+        self.assertEqual(len(inventory_ids), 5)
+        for inventory_id in inventory_ids[:3]:
+            self.assertIsNotNone(Inventory.find(inventory_id))
+        self.assertIsNone(inventory_ids[3])
+        self.assertIsNone(inventory_ids[4])
+        self.assertEqual(len(Inventory.all()), 4)
+
+        self.assertEqual(Inventory.create_batch([]), [])
+        self.assertRaises(DataValidationError, Inventory.create_batch, [{}])
+
+    def test_change_quantity(self):
+        """It should atomically change the quantity and restock_level"""
+        inventory = InventoryFactory(quantity=10, restock_level=RestockLevel.PLENTY)
+        inventory.create()
+
+        changed = Inventory.change_quantity(
+            inventory.product_id, inventory.condition.name, -10)
+        self.assertEqual(changed["quantity"], 0)
+        self.assertEqual(changed["restock_level"], "EMPTY")
+
+        changed = Inventory.change_quantity(
+            inventory.product_id, inventory.condition, 600)
+        self.assertEqual(changed["quantity"], 600)
+        self.assertEqual(changed["restock_level"], "PLENTY")
+        found = Inventory.find(inventory.inventory_id)
+        self.assertEqual(found.quantity, 600)
+        self.assertEqual(found.restock_level, RestockLevel.PLENTY)
+
+        self.assertRaises(
+            InsufficientQuantityError,
+            Inventory.change_quantity,
+            inventory.product_id, inventory.condition, -601
+        )
+        self.assertIsNone(Inventory.change_quantity(
+            inventory.product_id + 1, inventory.condition, 1))
+        self.assertRaises(
+            DataValidationError,
+            Inventory.change_quantity,
+            inventory.product_id, inventory.condition, "1"
+        )
+        self.assertRaises(
+            DataValidationError,
+            Inventory.change_quantity,
+            inventory.product_id, "BROKEN", 1
+        )
+        # a delta beyond the integer column leaves the row untouched
+        self.assertRaises(
+            DataValidationError,
+            Inventory.change_quantity,
+            inventory.product_id, inventory.condition, 2**40
+        )
+        self.assertEqual(Inventory.find(inventory.inventory_id).quantity, 600)
+
+    def test_change_quantity_concurrently(self):
+        """It should move a row out of its latest restock level when deltas race"""
+        inventory = InventoryFactory(quantity=60, restock_level=RestockLevel.MODERATE)
+        inventory.create()
+        product_id, condition = inventory.product_id, inventory.condition
+        self._race(lambda: Inventory.change_quantity(product_id, condition, -20),
+                   lambda: Inventory.change_quantity(product_id, condition, -20))
+        found = Inventory.find(inventory.inventory_id)
+        self.assertEqual((found.quantity, found.restock_level), (20, RestockLevel.LOW))
+        self.assertEqual(InventorySummary.verify(), [])
+
+    def test_find_rows(self):
+        """It should return plain serialized rows without the ORM"""
+        inventories = []
+        for _ in range(5):
+            inventory = InventoryFactory()
+            inventory.create()
+            inventories.append(inventory)
+        expected = sorted((inv.serialize() for inv in inventories),
+                          key=lambda row: row["inventory_id"])
+
+        rows = Inventory.find_rows({})
+        self.assertEqual(sorted(rows, key=lambda row: row["inventory_id"]), expected)
+        self.assertEqual(list(Inventory.iter_rows({}, 2)), rows)
+
+        # the rows come from a server-side cursor that is still open
+        # after the first chunk, not from a fully fetched result
+        stream = Inventory.iter_rows({}, 2)
+        next(stream)
+        open_cursors = db.session.execute(db.text("SELECT count(*) FROM pg_cursors")).scalar()
+        self.assertEqual(open_cursors, 1)
+        self.assertEqual(len(list(stream)), 4)
+
+        condition = inventories[0].condition.name
+        for row in Inventory.find_rows({"condition": condition}):
+            self.assertEqual(row["condition"], condition)
+
+        # keyset pages
+        page = Inventory.find_rows({}, limit=2)
+        self.assertEqual(page, expected[:2])
+        page = Inventory.find_rows({}, limit=2, after=page[-1]["inventory_id"])
+        self.assertEqual(page, expected[2:4])
+
+        self.assertEqual(Inventory.find_row(expected[0]["inventory_id"]), expected[0])
+        self.assertIsNone(Inventory.find_row(0))
+
+    def test_find_rows_ranges_and_sort(self):
+        """It should filter by value lists and ranges and page in any sort order"""
+        inventories = []
+        for quantity in (0, 5, 5, 20, 40):
+            inventory = InventoryFactory(quantity=quantity)
+            inventory.create()
+            inventories.append(inventory)
+
+        product_ids = f"{inventories[0].product_id},{inventories[1].product_id}"
+        rows = Inventory.find_rows({"product_id": product_ids})
+        self.assertEqual(sorted(row["inventory_id"] for row in rows),
+                         sorted(inv.inventory_id for inv in inventories[:2]))
+        conditions = {inventories[0].condition.name, inventories[1].condition.name}
+        for row in Inventory.find_rows({"condition": ",".join(conditions)}):
+            self.assertIn(row["condition"], conditions)
+
+        rows = Inventory.find_rows({"quantity_min": 5, "quantity_max": 20})
+        self.assertEqual(sorted(row["quantity"] for row in rows), [5, 5, 20])
+        self.assertEqual(len(Inventory.find_rows({"quantity": 0})), 1)
+
+        # descending pages break ties between equal quantities by inventory_id
+        expected = sorted((inv.serialize() for inv in inventories),
+                          key=lambda row: (-row["quantity"], -row["inventory_id"]))
+        seen, after = [], None
+        while True:
+            page = Inventory.find_rows({}, limit=2, after=after, sort="-quantity")
+            seen += page
+            if len(page) < 2:
+                break
+            after = Inventory.cursor_of(page[-1], "-quantity")
+        self.assertEqual(seen, expected)
+
+        self.assertRaises(DataValidationError, Inventory.find_rows, {}, sort="price")
+        self.assertRaises(DataValidationError, Inventory.find_rows, {},
+                          limit=2, after="1", sort="quantity")
+        self.assertRaises(ValueError, Inventory.find_rows, {"product_id": "1,b"})
+
+    def test_find_changes(self):
+        """It should return the rows changed and deleted after a cursor"""
+        inventories = []
+        for _ in range(4):
+            inventory = InventoryFactory()
+            inventory.create()
+            inventories.append(inventory)
+        start = ChangeCounter.current()
+
+        changes, cursor, more = Inventory.find_changes(None)
+        self.assertEqual([change["inventory_id"] for change in changes],
+                         [inv.inventory_id for inv in inventories])
+        self.assertFalse(any(change["deleted"] for change in changes))
+        self.assertEqual(cursor, str(start))
+        self.assertFalse(more)
+        self.assertEqual(Inventory.find_changes(cursor), ([], cursor, False))
+
+        # only the churn since the cursor comes back, deletes as tombstones
+        rows = [inv.serialize() for inv in inventories]
+        updated = inventories[1]
+        updated.update(dict(rows[1], quantity=rows[1]["quantity"] + 1))
+        inventories[2].delete()
+        Inventory.delete_by_attributes({"product_id": rows[3]["product_id"]})
+        Inventory.create_batch([{"product_id": rows[0]["product_id"] + 1000, "condition": "NEW"}])
+
+        changes, cursor, more = Inventory.find_changes(str(start))
+        self.assertEqual([(change["inventory_id"], change["deleted"]) for change in changes[:3]], [
+            (rows[1]["inventory_id"], False),
+            (rows[2]["inventory_id"], True),
+            (rows[3]["inventory_id"], True),
+        ])
+        self.assertEqual(changes[0]["quantity"], rows[1]["quantity"] + 1)
+        self.assertEqual(changes[1]["product_id"], rows[2]["product_id"])
+        versions = [change["version"] for change in changes]
+        self.assertEqual(versions, sorted(set(versions)))
+        self.assertLess(start, versions[0])
+        self.assertEqual(len(changes), 4)
+        self.assertEqual(cursor, str(ChangeCounter.current()))
+
+        # pages may end inside the changes of one transaction
+        Inventory.create_batch([{"product_id": rows[0]["product_id"] + 2000 + i,
+                                 "condition": "USED"} for i in range(3)])
+        seen = []
+        while True:
+            page, cursor, more = Inventory.find_changes(cursor, limit=2)
+            seen += page
+            if not more:
+                break
+            self.assertEqual(len(cursor.split(",")), 2)
+        self.assertEqual(len(seen), 3)
+        self.assertEqual(len({change["inventory_id"] for change in seen}), 3)
+
+        self.assertRaises(DataValidationError, Inventory.find_changes, "a")
+        self.assertRaises(DataValidationError, Inventory.find_changes, "1,2,3")
+        self.assertEqual(db.session.query(InventoryTombstone).count(), 2)
+
+    def test_change_versions(self):
+        """It should advance the row version on every write and the watermark on every commit"""
+        start = ChangeCounter.current()
+        inventory = InventoryFactory()
+        inventory.create()
+        self.assertLess(start, inventory.version)
+        self.assertLessEqual(inventory.version, ChangeCounter.current())
+
+        version = inventory.version
+        inventory.update(inventory.serialize())
+        self.assertLess(version, inventory.version)
+
+        version = inventory.version
+        changed = Inventory.change_quantity(
+            inventory.product_id, inventory.condition, 1)
+        self.assertLess(version, changed["version"])
+        self.assertLessEqual(changed["version"], ChangeCounter.current())
+
+        # a write still in flight holds the watermark below its version
+        with db.engine.connect() as connection:
+            transaction = connection.begin()
+            in_flight = connection.execute(
+                db.text("SELECT pg_current_xact_id()::text::bigint")).scalar_one()
+            changed = Inventory.change_quantity(
+                inventory.product_id, inventory.condition, -1)
+            self.assertLess(ChangeCounter.current(), in_flight)
+            self.assertLess(in_flight, changed["version"])
+            transaction.rollback()
+        self.assertLessEqual(changed["version"], ChangeCounter.current())
+
+    def test_update_stale_version(self):
+        """It should not Update an inventory changed since it was read"""
+        inventory = InventoryFactory()
+        inventory.create()
+        inventory = Inventory.find(inventory.inventory_id)
+        inventory_data = inventory.serialize()
+
+        # a stale version in the data is rejected up front
+        stale_data = dict(inventory_data, version=inventory.version - 1)
+        self.assertRaises(StaleVersionError, inventory.update, stale_data)
+        for version in ("abc", [1]):
+            bad_data = dict(inventory_data, version=version)
+            self.assertRaises(DataValidationError, inventory.update, bad_data)
+
+        # another connection writes the row behind the session's back
+        with db.engine.begin() as connection:
+            connection.execute(
+                Inventory.__table__.update()
+                .where(Inventory.inventory_id == inventory.inventory_id)
+                .values(quantity=0, version=Inventory.version + 100)
+            )
+        inventory_data["quantity"] += 1
+        inventory_data.pop("version")
+        self.assertRaises(StaleVersionError, inventory.update, inventory_data)
+
+        found = Inventory.find(inventory.inventory_id)
+        self.assertEqual(found.quantity, 0)
+
+    def test_summarize(self):
+        """It should count and sum inventories grouped in the database"""
+        InventoryFactory(product_id=1, condition=Condition.NEW,
+                         restock_level=RestockLevel.LOW, quantity=10).create()
+        InventoryFactory(product_id=2, condition=Condition.NEW,
+                         restock_level=RestockLevel.LOW, quantity=5).create()
+        InventoryFactory(product_id=3, condition=Condition.NEW,
+                         restock_level=RestockLevel.PLENTY, quantity=700).create()
+        InventoryFactory(product_id=4, condition=Condition.USED,
+                         restock_level=RestockLevel.LOW, quantity=1).create()
+
+        groups = Inventory.summarize(["condition", "restock_level"], {})
+        self.assertEqual(groups, [
+            {"condition": "NEW", "restock_level": "LOW", "count": 2, "quantity": 15},
+            {"condition": "NEW", "restock_level": "PLENTY", "count": 1, "quantity": 700},
+            {"condition": "USED", "restock_level": "LOW", "count": 1, "quantity": 1},
+        ])
+        groups = Inventory.summarize(["restock_level"], {"condition": "NEW"})
+        self.assertEqual(groups, [
+            {"restock_level": "LOW", "count": 2, "quantity": 15},
+            {"restock_level": "PLENTY", "count": 1, "quantity": 700},
+        ])
+        groups = Inventory.summarize([], {}, product_id_min=2, product_id_max=3)
+        self.assertEqual(groups, [{"count": 2, "quantity": 705}])
+        self.assertRaises(DataValidationError, Inventory.summarize, ["quantity"], {})
+
+    def test_inventory_summary_maintained(self):
+        """It should keep the inventory summary in step with every write path"""
+        inventory = InventoryFactory(quantity=10)
+        inventory.create()
+        Inventory.create_batch([InventoryFactory().serialize() for _ in range(5)])
+        inventory_data = inventory.serialize()
+        inventory_data["quantity"] = 20
+        inventory_data["restock_level"] = "PLENTY"
+        inventory.update(inventory_data)
+        Inventory.change_quantity(inventory.product_id, inventory.condition, -20)
+        self.assertEqual(InventorySummary.verify(), [])
+
+        Inventory.find(inventory.inventory_id).delete()
+        Inventory.delete_by_attributes({"condition": "NEW"}, chunk_size=2)
+        self.assertEqual(InventorySummary.verify(), [])
+
+        groups = Inventory.summarize(["condition"], {})
+        self.assertEqual(sum(group["count"] for group in groups), len(Inventory.all()))
+
+    def test_inventory_summary_rebuild(self):
+        """It should detect drift in the inventory summary and rebuild it"""
+        for _ in range(3):
+            InventoryFactory().create()
+        db.session.query(InventorySummary).delete()
+        db.session.commit()
+        self.assertNotEqual(InventorySummary.verify(), [])
+
+        InventorySummary.rebuild()
+        self.assertEqual(InventorySummary.verify(), [])
+        groups = Inventory.summarize([], {})
+        self.assertEqual(groups[0]["count"], 3)
+
+    def test_derive_restock_level(self):
+        """It should derive the restock level from the quantity thresholds"""
+        app.config["RESTOCK_LEVEL_DERIVED"] = True
+        try:
+            inventory = InventoryFactory(product_id=7, quantity=60,
+                                         restock_level=RestockLevel.EMPTY)
+            inventory.create()
+            self.assertEqual(Inventory.find(inventory.inventory_id).restock_level,
+                             RestockLevel.MODERATE)
+
+            inventory_data = inventory.serialize()
+            inventory_data["quantity"] = 0
+            inventory.update(inventory_data)
+            self.assertEqual(Inventory.find(inventory.inventory_id).restock_level,
+                             RestockLevel.EMPTY)
+
+            rows = [InventoryFactory(product_id=8, quantity=500).serialize()]
+            Inventory.create_batch(rows)
+            found = Inventory.find_by_attributes({"product_id": 8})[0]
+            self.assertEqual(found.restock_level, RestockLevel.PLENTY)
+            self.assertEqual(InventorySummary.verify(), [])
+        finally:
+            app.config["RESTOCK_LEVEL_DERIVED"] = False
+
+    def test_restock_thresholds(self):
+        """It should recompute the restock levels when the thresholds of a product change"""
+        inventory = InventoryFactory(product_id=7, quantity=60,
+                                     restock_level=RestockLevel.MODERATE)
+        inventory.create()
+        other = InventoryFactory(product_id=8, quantity=60,
+                                 restock_level=RestockLevel.MODERATE)
+        other.create()
+
+        threshold = RestockThreshold.save(7, {"low": 10, "moderate": 100, "plenty": 1000})
+        self.assertEqual(threshold.serialize(),
+                         {"product_id": 7, "low": 10, "moderate": 100, "plenty": 1000})
+        self.assertEqual(Inventory.find(inventory.inventory_id).restock_level,
+                         RestockLevel.LOW)
+        self.assertEqual(Inventory.find(other.inventory_id).restock_level,
+                         RestockLevel.MODERATE)
+        self.assertEqual(InventorySummary.verify(), [])
+
+        Inventory.change_quantity(7, inventory.condition, 100)
+        self.assertEqual(Inventory.find(inventory.inventory_id).restock_level,
+                         RestockLevel.MODERATE)
+
+        RestockThreshold.remove(7)
+        self.assertIsNone(RestockThreshold.find(7))
+        self.assertEqual(Inventory.find(inventory.inventory_id).restock_level,
+                         RestockLevel.MODERATE)
+        self.assertEqual(Inventory.recompute_restock_levels(), 0)
+
+        self.assertRaises(DataValidationError, RestockThreshold.save, 7,
+                          {"low": 10, "moderate": 5, "plenty": 1000})
+        self.assertRaises(DataValidationError, RestockThreshold.save, 7, {"low": 10})
+        self.assertRaises(DataValidationError, RestockThreshold.save, 7,
+                          {"low": "a", "moderate": 5, "plenty": 1000})
+
+    def test_recompute_restock_levels_concurrently(self):
+        """It should recompute from the latest restock level when an update races"""
+        inventory = InventoryFactory(product_id=7, quantity=60, restock_level=RestockLevel.EMPTY)
+        inventory.create()
+
+        def update():
+            found = Inventory.find(inventory.inventory_id)
+            found.update(dict(found.serialize(), restock_level="PLENTY"))
+
+        self._race(update, lambda: Inventory.recompute_restock_levels(7))
+        self.assertEqual(Inventory.find(inventory.inventory_id).restock_level,
+                         RestockLevel.MODERATE)
+        self.assertEqual(InventorySummary.verify(), [])
+
+    def test_copy_rows(self):
+        """It should load records with COPY and keep the summary in step"""
+        rows = [
+            (1, Condition.NEW, RestockLevel.LOW, 10),
+            (2, Condition.USED, RestockLevel.PLENTY, 700),
+        ]
+        self.assertEqual(Inventory.copy_rows(rows), 2)
+        found = Inventory.find_by_attributes({"product_id": 2})
+        self.assertEqual(found[0].quantity, 700)
+        self.assertLessEqual(found[0].version, ChangeCounter.current())
+        self.assertEqual(InventorySummary.verify(), [])
+
+        self.assertRaises(DuplicateKeyValueError, Inventory.copy_rows, rows[:1])
+        self.assertEqual(len(Inventory.all()), 2)
+        self.assertEqual(InventorySummary.verify(), [])
+
+    def test_dispose_engines(self):
+        """It should give a forked worker a fresh connection pool"""
+        engine = db.engine
+        pool = engine.pool
+        ChangeCounter.current()
+        dispose_engines(app)
+        self.assertIs(db.engine, engine)
+        self.assertIsNot(engine.pool, pool)
@@ -6,11 +6,16 @@
 #   coverage report -m
 # """
 import os
+import csv
+import gzip
+import json
 import logging
 from unittest import TestCase
 from tests.factory import InventoryFactory, Condition
 from service import app
-from service.models import db, Inventory, init_db
+from service.models import (
+    db, Inventory, InventorySummary, InventoryTombstone, RestockThreshold, ChangeCounter, init_db,
+)
 from service.utils import status  # HTTP Status Codes
 
 DATABASE_URI = os.getenv(
@@ -33,17 +38,22 @@ class TestInventoryServer(TestCase):
         app.config["TESTING"] = True
         app.config["DEBUG"] = True
         app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
+        app.config["CACHE_TYPE"] = "lru"
         app.logger.setLevel(logging.CRITICAL)
         init_db(app)
 
     @classmethod
     def tearDownClass(cls):
         """This runs once after the entire test suite"""
+        app.config["CACHE_TYPE"] = "null"
         db.drop_all()
 
     def setUp(self):
         """This runs before each test"""
         db.session.query(Inventory).delete()  # clean up the last tests
+        db.session.query(InventorySummary).delete()
+        db.session.query(RestockThreshold).delete()
+        db.session.query(InventoryTombstone).delete()
         db.session.commit()
         self.client = app.test_client()
 
@@ -177,6 +187,151 @@ class TestInventoryServer(TestCase):
         data = resp.get_json()
         self.assertEqual(len(data), 6)
 
+    def test_list_inventory_pages(self):
+        """It should list Inventories in keyset pages"""
+        inventories = self._create_inventories(5)
+        inventory_ids = sorted(inventory.inventory_id for inventory in inventories)
+
+        resp = self.client.get(BASE_URL_NEW + "?limit=2")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual([item["inventory_id"] for item in data], inventory_ids[:2])
+        self.assertEqual(resp.headers["X-Next-Cursor"], str(inventory_ids[1]))
+        self.assertIn('rel="next"', resp.headers["Link"])
+
+        # follow the next links until the last page
+        seen = [item["inventory_id"] for item in data]
+        while "Link" in resp.headers:
+            next_url = resp.headers["Link"].split(";")[0].strip("<>")
+            resp = self.client.get(next_url)
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            seen += [item["inventory_id"] for item in resp.get_json()]
+        self.assertEqual(seen, inventory_ids)
+
+        # pages compose with the filters
+        condition = inventories[0].condition.name
+        resp = self.client.get(
+            BASE_URL_NEW + f"?condition={condition}&after={inventory_ids[0] - 1}")
+        expected = [inv.inventory_id for inv in inventories
+                    if inv.condition.name == condition]
+        self.assertEqual(sorted(item["inventory_id"] for item in resp.get_json()),
+                         sorted(expected))
+
+        resp = self.client.get(BASE_URL_NEW + "?limit=0")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_list_inventory_sorted_pages(self):
+        """It should list filtered Inventories in sorted keyset pages"""
+        inventories = self._create_inventories(8)
+        conditions = ("NEW", "OPEN_BOX")
+        expected = sorted(
+            (inv for inv in inventories
+             if inv.condition.name in conditions and inv.quantity <= 500),
+            key=lambda inv: (-inv.quantity, -inv.inventory_id))
+
+        resp = self.client.get(
+            BASE_URL_NEW + "?condition=NEW,OPEN_BOX&quantity_max=500&sort=-quantity&limit=2")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        seen = [item["inventory_id"] for item in resp.get_json()]
+        while "Link" in resp.headers:
+            next_url = resp.headers["Link"].split(";")[0].strip("<>")
+            self.assertIn("sort=-quantity", next_url)
+            resp = self.client.get(next_url)
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            seen += [item["inventory_id"] for item in resp.get_json()]
+        self.assertEqual(seen, [inv.inventory_id for inv in expected])
+
+        resp = self.client.get(BASE_URL_NEW + "?sort=price")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.client.get(BASE_URL_NEW + "?sort=quantity&after=1")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_list_inventory_changes(self):
+        """It should return the Inventory changes since a cursor"""
+        inventories = self._create_inventories(3)
+        resp = self.client.get(BASE_URL_NEW + "/changes")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([item["inventory_id"] for item in resp.get_json()],
+                         [inv.inventory_id for inv in inventories])
+        self.assertNotIn("Link", resp.headers)
+        cursor = resp.headers["X-Next-Cursor"]
+
+        resp = self.client.delete(f"{BASE_URL_NEW}/{inventories[0].inventory_id}")
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        self._create_inventories(2)
+
+        resp = self.client.get(BASE_URL_NEW + f"/changes?since={cursor}&limit=2")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(data[0]["inventory_id"], inventories[0].inventory_id)
+        self.assertTrue(data[0]["deleted"])
+        self.assertIn('rel="next"', resp.headers["Link"])
+
+        next_url = resp.headers["Link"].split(";")[0].strip("<>")
+        resp = self.client.get(next_url)
+        self.assertEqual(len(resp.get_json()), 1)
+        self.assertNotIn("Link", resp.headers)
+
+        resp = self.client.get(BASE_URL_NEW + "/changes?since=abc")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.client.get(BASE_URL_NEW + "/changes?limit=0")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_export_inventories(self):
+        """It should stream the filtered Inventories as CSV or JSON Lines"""
+        inventories = self._create_inventories(5)
+        app.config["STREAM_CHUNK_SIZE"] = 2
+        self.addCleanup(app.config.update, STREAM_CHUNK_SIZE=1000)
+        inventory_ids = sorted(inv.inventory_id for inv in inventories)
+
+        resp = self.client.get(BASE_URL_NEW + "/export", buffered=False)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertTrue(resp.content_type.startswith("text/csv"))
+        self.assertIn("inventory.csv", resp.headers["Content-Disposition"])
+        self.assertEqual(int(resp.headers["X-Change-Cursor"]), ChangeCounter.current())
+        # the header and three chunks of at most two rows
+        chunks = list(resp.response)
+        self.assertEqual(len(chunks), 4)
+        rows = list(csv.DictReader(b"".join(chunks).decode().splitlines()))
+        self.assertEqual([int(row["inventory_id"]) for row in rows], inventory_ids)
+        self.assertEqual(rows[0]["condition"], Inventory.find(inventory_ids[0]).condition.name)
+
+        condition = inventories[0].condition.name
+        resp = self.client.get(BASE_URL_NEW + f"/export?format=jsonl&gzip=true&condition={condition}")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.content_type, "application/gzip")
+        self.assertIn("inventory.jsonl.gz", resp.headers["Content-Disposition"])
+        rows = [json.loads(line) for line in gzip.decompress(resp.data).decode().splitlines()]
+        expected = sorted(inv.inventory_id for inv in inventories if inv.condition.name == condition)
+        self.assertEqual([row["inventory_id"] for row in rows], expected)
+        self.assertEqual(set(rows[0]), set(Inventory.find_row(expected[0])))
+
+        resp = self.client.get(BASE_URL_NEW + "/export?quantity_max=-1")
+        self.assertEqual(resp.data.decode().splitlines(),
+                         ["inventory_id,product_id,condition,restock_level,quantity,version"])
+
+        for query in ("format=xml", "condition=BROKEN", "sort=price"):
+            resp = self.client.get(BASE_URL_NEW + f"/export?{query}")
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST, query)
+
+    def test_list_inventory_ndjson(self):
+        """It should stream the Inventory list as NDJSON"""
+        inventories = self._create_inventories(3)
+        resp = self.client.get(BASE_URL_NEW,
+                               headers={"Accept": "application/x-ndjson"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, "application/x-ndjson")
+        lines = resp.get_data(as_text=True).splitlines()
+        data = [json.loads(line) for line in lines]
+        self.assertEqual(sorted(item["inventory_id"] for item in data),
+                         sorted(inventory.inventory_id for inventory in inventories))
+
+        condition = inventories[0].condition.name
+        resp = self.client.get(BASE_URL_NEW + f"?condition={condition}",
+                               headers={"Accept": "application/x-ndjson"})
+        for line in resp.get_data(as_text=True).splitlines():
+            self.assertEqual(json.loads(line)["condition"], condition)
+
     def test_read_inventory(self):
         """It should Read a single Inventory"""
         # get the id of an Inventory
@@ -330,9 +485,9 @@ class TestInventoryServer(TestCase):
         data = resp.get_json()
         self.assertEqual(len(data), 5)
 
-        # Should ignore invalid attributes
+        # Should refuse invalid attributes and delete nothing
         resp = self.client.delete(DELETE_ALL_URL + "?condition=0")
-        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
         # list all inventories
         resp = self.client.get(BASE_URL_NEW)
         data = resp.get_json()
@@ -346,6 +501,55 @@ class TestInventoryServer(TestCase):
         data = resp.get_json()
         self.assertEqual(data, [])
 
+    def test_delete_all_inventories_count(self):
+        """It should report how many Inventories were deleted"""
+        self._create_inventories(5)
+        resp = self.client.delete(BASE_URL_NEW + "/clear?chunk_size=2")
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(resp.headers["X-Deleted-Count"], "5")
+
+        resp = self.client.delete(BASE_URL_NEW + "/clear")
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(resp.headers["X-Deleted-Count"], "0")
+
+        resp = self.client.delete(BASE_URL_NEW + "/clear?chunk_size=-1")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_bulk_create_inventories(self):
+        """It should Create Inventories in bulk with a status per item"""
+        existing = self._create_inventories(1)[0].serialize()
+        items = [InventoryFactory().serialize() for _ in range(3)]
+        bad_item = InventoryFactory().serialize()
+        bad_item.pop("product_id")
+        # beyond the integer column, it must not fail the rest of its batch
+        huge_item = dict(InventoryFactory().serialize(), product_id=2**40)
+        items += [existing, bad_item, huge_item]
+
+        resp = self.client.post(BASE_URL_NEW + "/bulk?batch_size=2", json=items)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(data["created"], 3)
+        self.assertEqual(data["conflicts"], 1)
+        self.assertEqual(data["failed"], 2)
+        statuses = [result["status"] for result in data["results"]]
+        self.assertEqual(statuses, [201, 201, 201, 409, 400, 400])
+        self.assertIn("maximum", data["results"][5]["message"])
+        resp = self.client.get(f"{BASE_URL}/{data['results'][0]['inventory_id']}")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+    def test_bulk_create_inventories_ndjson(self):
+        """It should Create Inventories in bulk from an NDJSON body"""
+        items = [InventoryFactory().serialize() for _ in range(2)]
+        body = "\n".join(json.dumps(item) for item in items) + "\nnot json\n"
+        resp = self.client.post(BASE_URL_NEW + "/bulk", data=body,
+                                content_type="application/x-ndjson")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(data["created"], 2)
+        self.assertEqual(data["failed"], 1)
+        resp = self.client.get(BASE_URL_NEW)
+        self.assertEqual(len(resp.get_json()), 2)
+
     def test_update_inventory_by_product_id_condition(self):
         """It should Update an Inventory by its product_id & condition"""
         # create & get the id of an Inventory
@@ -370,6 +574,174 @@ class TestInventoryServer(TestCase):
         self.assertEqual(
             updated["restock_level"], inventory.restock_level.name)
 
+    def test_change_quantity_by_delta(self):
+        """It should change the quantity of an Inventory by a delta"""
+        inventory = self._create_inventories(1)[0]
+        request_json = {
+            "product_id": inventory.product_id,
+            "condition": inventory.condition.name,
+            "delta": -inventory.quantity,
+        }
+        resp = self.client.put(BASE_URL + "/changeQuantity", json=request_json)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(data["quantity"], 0)
+        self.assertEqual(data["restock_level"], "EMPTY")
+
+        # the stock can not go below zero
+        request_json["delta"] = -1
+        resp = self.client.put(BASE_URL + "/changeQuantity", json=request_json)
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+
+        request_json["product_id"] += 1
+        resp = self.client.put(BASE_URL + "/changeQuantity", json=request_json)
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_read_inventory_cache(self):
+        """It should serve repeated reads from the cache and invalidate on writes"""
+        inventory = self._create_inventories(1)[0]
+        url = f"{BASE_URL}/{inventory.inventory_id}"
+        hits = self.client.get("/stats").get_json()["cache"]["hits"]
+        self.client.get(url)
+        resp = self.client.get(url)
+        self.assertEqual(resp.get_json()["quantity"], inventory.quantity)
+        stats = self.client.get("/stats").get_json()
+        self.assertEqual(stats["cache"]["hits"], hits + 1)
+        self.assertGreater(stats["pool"]["checkouts"], 0)
+
+        # the write paths invalidate the cached entry
+        new_inventory = inventory.serialize()
+        new_inventory["quantity"] = 42
+        self.client.put(url, json=new_inventory)
+        self.assertEqual(self.client.get(url).get_json()["quantity"], 42)
+
+        new_inventory["delta"] = 1
+        self.client.put(BASE_URL + "/changeQuantity", json=new_inventory)
+        self.assertEqual(self.client.get(url).get_json()["quantity"], 43)
+
+        self.client.delete(BASE_URL_NEW + "/clear")
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_read_inventory_cache_revalidation(self):
+        """It should not answer 304 from a cached version another worker changed"""
+        inventory = self._create_inventories(1)[0]
+        url = f"{BASE_URL}/{inventory.inventory_id}"
+        etag = self.client.get(url).headers["ETag"]
+        # a write of another worker does not invalidate this worker's cache
+        db.session.execute(Inventory.__table__.update().where(
+            Inventory.inventory_id == inventory.inventory_id).values(quantity=7, version=Inventory.version + 1))
+        db.session.commit()
+
+        resp = self.client.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["quantity"], 7)
+        self.assertNotEqual(resp.headers["ETag"], etag)
+        # the revalidation refilled the cache
+        self.assertEqual(self.client.get(url).get_json()["quantity"], 7)
+
+    def test_read_inventory_etag(self):
+        """It should answer 304 Not Modified for an unchanged Inventory"""
+        inventory = self._create_inventories(1)[0]
+        url = f"{BASE_URL}/{inventory.inventory_id}"
+        resp = self.client.get(url)
+        etag = resp.headers["ETag"]
+        resp = self.client.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(resp.get_data(), b"")
+
+        # a write changes the ETag
+        new_inventory = inventory.serialize()
+        new_inventory["quantity"] = 42
+        resp = self.client.put(url, json=new_inventory)
+        new_etag = resp.headers["ETag"]
+        self.assertNotEqual(new_etag, etag)
+        resp = self.client.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.headers["ETag"], new_etag)
+
+    def test_list_inventory_etag(self):
+        """It should answer 304 Not Modified for an unchanged Inventory list"""
+        self._create_inventories(2)
+        resp = self.client.get(BASE_URL_NEW)
+        etag = resp.headers["ETag"]
+        resp = self.client.get(BASE_URL_NEW, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        self.assertEqual(resp.headers["Vary"], "Accept")
+
+        resp = self.client.get(BASE_URL_NEW, headers={
+            "If-None-Match": etag, "Accept": "application/x-ndjson"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.headers["Vary"], "Accept")
+
+        # the ETag of one query does not answer another, nor an invalid one
+        for query in ("?condition=USED", "?limit=1", "?sort=-quantity"):
+            resp = self.client.get(BASE_URL_NEW + query, headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, status.HTTP_200_OK, query)
+        for query in ("?sort=bogus", "?limit=0", "?after=a"):
+            resp = self.client.get(BASE_URL_NEW + query, headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST, query)
+
+        self.client.delete(BASE_URL_NEW + "/clear")
+        resp = self.client.get(BASE_URL_NEW, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), [])
+
+    def test_update_inventory_if_match(self):
+        """It should Update an Inventory only when If-Match is current"""
+        inventory = self._create_inventories(1)[0]
+        url = f"{BASE_URL}/{inventory.inventory_id}"
+        etag = self.client.get(url).headers["ETag"]
+        new_inventory = inventory.serialize()
+        new_inventory["quantity"] = 42
+        resp = self.client.put(url, json=new_inventory, headers={"If-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+        # the old ETag is stale now
+        resp = self.client.put(url, json=new_inventory, headers={"If-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+
+    def test_summarize_inventories(self):
+        """It should summarize the Inventories grouped by condition"""
+        inventories = self._create_inventories(4)
+        resp = self.client.get(BASE_URL_NEW + "/summary?group_by=condition")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(data["total"]["count"], 4)
+        self.assertEqual(data["total"]["quantity"],
+                         sum(inventory.quantity for inventory in inventories))
+        for group in data["groups"]:
+            expected = [inv for inv in inventories if inv.condition.name == group["condition"]]
+            self.assertEqual(group["count"], len(expected))
+
+        resp = self.client.get(BASE_URL_NEW + "/summary?group_by=quantity")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_restock_thresholds(self):
+        """It should set, read and delete the restock thresholds of a product"""
+        inventory = self._create_inventories(1)[0]
+        url = f"/api/thresholds/{inventory.product_id}"
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+        thresholds = {"low": 0, "moderate": 0, "plenty": 0}
+        resp = self.client.put(url, json=thresholds)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), dict(thresholds, product_id=inventory.product_id))
+        resp = self.client.get(f"{BASE_URL}/{inventory.inventory_id}")
+        self.assertEqual(resp.get_json()["restock_level"], "PLENTY")
+
+        resp = self.client.put(url, json={"low": 5, "moderate": 1, "plenty": 0})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.client.put(url, data="low=1", content_type="text/plain")
+        self.assertEqual(resp.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+
+        resp = self.client.delete(url)
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
     ######################################################################
     #  T E S T   S A D   P A T H S
     ######################################################################
@@ -433,6 +805,33 @@ class TestInventoryServer(TestCase):
         self.assertEqual(
             resp.status_code, status.HTTP_400_BAD_REQUEST)
 
+    def test_bulk_create_inventories_bad_body(self):
+        """It should not Create Inventories in bulk from a non-array body"""
+        resp = self.client.post(BASE_URL_NEW + "/bulk", json={"product_id": 1})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.client.post(BASE_URL_NEW + "/bulk", data="[]",
+                                content_type="text/plain")
+        self.assertEqual(resp.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+        for batch_size in (0, -1):
+            resp = self.client.post(BASE_URL_NEW + f"/bulk?batch_size={batch_size}", json=[])
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_update_inventory_stale_version(self):
+        """It should not Update an Inventory from a stale version"""
+        inventory = self._create_inventories(1)[0]
+        url = f"{BASE_URL}/{inventory.inventory_id}"
+        current = self.client.get(url).get_json()
+        current["quantity"] += 1
+        resp = self.client.put(url, json=current)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+        # the same body again carries the version it was read at
+        resp = self.client.put(url, json=current)
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+
+        resp = self.client.put(url, json=dict(current, version="abc"))
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_read_inventory_not_found(self):
         """It should not Read the Inventory when it is not found"""
         resp = self.client.get(f"{BASE_URL}/0")